@@ -1,12 +1,14 @@
 
 import sys, os, time
-import glob, json, argparse, copy
-import socket, webbrowser
-from wsgiref.simple_server import WSGIRequestHandler, make_server
+import glob, json, argparse, copy, hashlib
+import cStringIO
+import socket, webbrowser, threading, Queue
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 from bottle import *
 from serial_manager import SerialManager
 from flash import flash_upload
-from filereaders import read_svg, read_dxf
+from filereaders import read_svg, read_dxf, optimize_all, make_pool, unpack_boundarys
+from parse_cache import ParseCache
 
 
 APPNAME = "lasaurapp"
@@ -20,6 +22,10 @@ CONFIG_FILE = "lasaurapp.conf"
 COOKIE_KEY = 'secret_key_jkn23489hsdf'
 FIRMWARE = "LasaurGrbl.hex"
 TOLERANCE = 0.08
+SEQUENCE_STEPS = 4000  # work to refine path order (~2s), for imports asking to refine
+OPTIMIZE_PROCESSES = 1  # per-color optimizing workers, None for one per cpu, see --optimize-processes
+SERVER_THREADS = 8  # request handler threads in 'threaded' server mode
+UPLOAD_CHUNK_SIZE = 64*1024  # bytes read at a time from streamed uploads
 
 
 if os.name == 'nt': #sys.platform == 'win32': 
@@ -67,6 +73,12 @@ def storage_dir():
     return directory
 
 
+# import results by file content and settings,
+# the disk tier gets set up in run_with_callback
+parse_cache = ParseCache()
+optimize_pool = None  # see run_with_callback
+
+
 class HackedWSGIRequestHandler(WSGIRequestHandler):
     """ This is a heck to solve super slow request handling
     on the BeagleBone and RaspberryPi. The problem is WSGIRequestHandler
@@ -81,18 +93,71 @@ class HackedWSGIRequestHandler(WSGIRequestHandler):
         return str(self.client_address[0])
 
 
-def run_with_callback(host, port):
+class ThreadPoolWSGIServer(WSGIServer):
+    """ WSGIServer that hands requests to a fixed pool of threads.
+    This way a slow request (e.g. a big upload) does not hold up
+    everybody else, most importantly the /status polling.
+    """
+    def __init__(self, server_address, RequestHandlerClass, pool_size=SERVER_THREADS):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+        self.requests = Queue.Queue()
+        for i in range(pool_size):
+            t = threading.Thread(target=self.process_request_worker)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_worker(self):
+        while 1:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+
+class LasaurAppServer(ServerAdapter):
+    """ bottle server adapter for the wsgiref server with
+    HackedWSGIRequestHandler. Pass threads=n to serve requests
+    from a pool of n threads, otherwise requests are served
+    one at a time.
+    """
+    quiet = True
+    def run(self, handler):
+        threads = self.options.get('threads', 0)
+        if threads:
+            def server_class(server_address, handler_class):
+                return ThreadPoolWSGIServer(server_address, handler_class, threads)
+        else:
+            server_class = WSGIServer
+        server = make_server(self.host, self.port, handler, 
+                             server_class=server_class, 
+                             handler_class=HackedWSGIRequestHandler)
+        server.serve_forever()
+
+
+def run_with_callback(host, port, server_mode='threaded'):
     """ Start a wsgiref server instance with control over the main loop.
         This is a function that I derived from the bottle.py run()
+        Serial I/O is handled by the SerialManager thread.
     """
+    # workers get forked, do this before any threads or devices exist
+    global optimize_pool
+    optimize_pool = make_pool(OPTIMIZE_PROCESSES)
     handler = default_app()
-    server = make_server(host, port, handler, handler_class=HackedWSGIRequestHandler)
-    server.timeout = 0.01
-    server.quiet = True
+    if server_mode == 'threaded':
+        server = LasaurAppServer(host, port, threads=SERVER_THREADS)
+    else:
+        server = LasaurAppServer(host, port)
     print "Persistent storage root is: " + storage_dir()
+    parse_cache.directory = os.path.join(storage_dir(), 'parse_cache')
     print "-----------------------------------------------------------------------------"
     print "Bottle server starting up ..."
     print "Serial is set to %d bps" % BITSPERSECOND
+    print "Server mode is '%s'" % server_mode
     print "Point your browser to: "    
     print "http://%s:%d/      (local)" % ('127.0.0.1', port)  
     # if host == '':
@@ -116,14 +181,18 @@ def run_with_callback(host, port):
     except webbrowser.Error:
         print "Cannot open Webbrowser, please do so manually."
     sys.stdout.flush()  # make sure everything gets flushed
-    while 1:
-        try:
-            SerialManager.send_queue_as_ready()
-            server.handle_request()
-        except KeyboardInterrupt:
-            break
+    # serial streaming runs on its own thread so slow
+    # requests cannot starve the firmware's rx buffer
+    SerialManager.start()
+    try:
+        server.run(handler)
+    except KeyboardInterrupt:
+        pass
     print "\nShutting down..."
+    SerialManager.stop()
     SerialManager.close()
+    if optimize_pool:
+        optimize_pool.terminate()
 
         
 
@@ -392,12 +461,94 @@ def flash_firmware_handler(firmware_file=FIRMWARE):
 
 @route('/gcode', method='POST')
 def gcode_submit_handler():
+    """Deprecated, post the program as raw body to /gcode/stream.
+    Raw (non-form) bodies are streamed the same way here. The form
+    field of older clients has to be read in full before queueing.
+    """
+    content_type = request.environ.get('CONTENT_TYPE', '')
+    if not content_type.startswith(('application/x-www-form-urlencoded',
+                                    'multipart/form-data')):
+        return gcode_stream_handler()
+    print "Deprecated: form post to /gcode, use /gcode/stream."
     gcode_program = request.forms.get('gcode_program')
     if gcode_program and SerialManager.is_connected():
-        lines = gcode_program.split('\n')
-        print "Adding to queue %s lines" % len(lines)
-        for line in lines:
-            SerialManager.queue_gcode_line(line)
+        # lines get encoded by the serial thread as it goes
+        line_count = gcode_program.count('\n') + 1
+        print "Adding to queue %s lines" % line_count
+        SerialManager.queue_gcode_stream(cStringIO.StringIO(gcode_program), line_count)
+        return "__ok__"
+    else:
+        return "serial disconnected"
+
+def iter_request_lines(chunk_size=UPLOAD_CHUNK_SIZE):
+    """Read the raw request body chunk by chunk.
+    Yields lists of complete lines as they come in.
+    """
+    stream = request.environ['wsgi.input']
+    remaining = int(request.environ.get('CONTENT_LENGTH') or 0)
+    tail = ''
+    while remaining > 0:
+        chunk = stream.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+class RequestBodyReader:
+    """File object reading the raw request body.
+    Hashes the data as it passes, see hexdigest().
+    """
+    def __init__(self, environ):
+        self._stream = environ['wsgi.input']
+        self._remaining = int(environ.get('CONTENT_LENGTH') or 0)
+        self._sha1 = hashlib.sha1()
+        self.count = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining
+        data = self._stream.read(min(size, self._remaining, UPLOAD_CHUNK_SIZE))
+        self._remaining -= len(data)
+        self._sha1.update(data)
+        self.count += len(data)
+        return data
+
+    def drain(self):
+        """Read what the consumer left, e.g. after a DXF's ENTITIES."""
+        while self.read(UPLOAD_CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+@route('/gcode/stream', method='POST')
+def gcode_stream_handler():
+    """Queue a gcode program sent as the raw request body.
+    Lines get encoded and queued while the upload is still coming
+    in so streaming to the machine starts right away and the whole
+    program never has to be in memory at once.
+    """
+    if not request.environ.get('CONTENT_LENGTH'):
+        # chunked transfer encoding is not supported
+        abort(411, "Content-Length required.")
+    if SerialManager.is_connected():
+        count = 0
+        # one job for the whole body, not one per chunk
+        job = SerialManager.begin_job()
+        try:
+            for lines in iter_request_lines():
+                if not SerialManager.queue_gcode_program(lines, job):
+                    # stopped while uploading, don't read the rest
+                    print "Job stopped, ignoring the rest of the upload."
+                    break
+                count += len(lines)
+        finally:
+            SerialManager.end_job(job)
+        print "Added to queue %s lines" % count
         return "__ok__"
     else:
         return "serial disconnected"
@@ -407,6 +558,21 @@ def queue_pct_done_handler():
     return SerialManager.get_queue_percentage_done()
 
 
+@route('/metrics')
+def metrics_handler():
+    """Serial link throughput and latency, see SerialMetrics."""
+    return json.dumps(SerialManager.get_metrics())
+
+@route('/metrics/reset')
+def metrics_reset_handler():
+    SerialManager.reset_metrics()
+    return '1'
+
+@route('/queue_progress')
+def queue_progress_handler():
+    return json.dumps(SerialManager.get_queue_progress())
+
+
 @route('/svg_reader', method='POST')
 def svg_upload():
     """Parse SVG string."""
@@ -424,19 +590,107 @@ def svg_upload():
     except:
         pass
 
+    improve_steps = 0  # refining the path order is opt-in
+    try:
+        if int(request.forms.get('refine')):
+            improve_steps = SEQUENCE_STEPS
+    except:
+        pass
+
     if filename and filedata:
         print "You uploaded %s (%d bytes)." % (filename, len(filedata))
-        if filename[-4:] in ['.dxf', '.DXF']: 
-            res = read_dxf(filedata, TOLERANCE, optimize)
+        is_dxf = filename[-4:] in ['.dxf', '.DXF']
+        cache_key = parse_cache.key(hashlib.sha1(filedata).hexdigest(), is_dxf,
+            dpi_forced, TOLERANCE, [1220,610], optimize, improve_steps)
+        jsondata = parse_cache.get(cache_key)
+        if jsondata is not None:
+            print "Returning cached import result."
+            return jsondata
+        if is_dxf:
+            res = read_dxf(filedata, TOLERANCE, optimize, improve_steps,
+                           pool=optimize_pool)
         else:
-            res = read_svg(filedata, [1220,610], TOLERANCE, dpi_forced, optimize)
+            res = read_svg(filedata, [1220,610], TOLERANCE, dpi_forced, optimize,
+                           improve_steps, pool=optimize_pool)
         # print boundarys
         jsondata = json.dumps(res)
+        parse_cache.put(cache_key, jsondata)
         # print "returning %d items as %d bytes." % (len(res['boundarys']), len(jsondata))
         return jsondata
     return "You missed a field."
 
 
+@route('/svg_reader/stream', method='POST')
+def svg_stream_upload():
+    """Parse SVG or DXF sent as the raw request body.
+    filename, dpi, optimize and refine are query parameters. The body goes
+    straight into the incremental readers so the document never has
+    to be in memory as a whole.
+    With the optional modified query parameter (the file's last
+    modified time) repeated imports of a file are looked up by
+    filename, size and modified before parsing and the body is
+    skipped on a hit. Otherwise the cache lookup has to wait for
+    the content hash, after parsing, and only saves the optimizing.
+    """
+    filename = request.GET.get('filename')
+    dpi_forced = None
+    try:
+        dpi_forced = float(request.GET.get('dpi'))
+    except:
+        pass
+
+    optimize = True
+    try:
+        optimize = bool(int(request.GET.get('optimize')))
+    except:
+        pass
+
+    improve_steps = 0  # refining the path order is opt-in
+    try:
+        if int(request.GET.get('refine')):
+            improve_steps = SEQUENCE_STEPS
+    except:
+        pass
+
+    if not request.environ.get('CONTENT_LENGTH'):
+        # chunked transfer encoding is not supported
+        abort(411, "Content-Length required.")
+    if filename:
+        is_dxf = filename[-4:] in ['.dxf', '.DXF']
+        settings = (is_dxf, dpi_forced, TOLERANCE, [1220,610], optimize, improve_steps)
+        body = RequestBodyReader(request.environ)
+        file_key = None
+        modified = request.GET.get('modified')
+        if modified:
+            file_id = json.dumps([filename, request.environ['CONTENT_LENGTH'], modified])
+            file_key = parse_cache.key(hashlib.sha1(file_id).hexdigest(), *settings)
+            jsondata = parse_cache.get(file_key)
+            if jsondata is not None:
+                body.drain()
+                print "Returning cached import result for %s." % filename
+                return jsondata
+        if is_dxf:
+            res = read_dxf(body, TOLERANCE, False, packed=True)
+        else:
+            res = read_svg(body, [1220,610], TOLERANCE, dpi_forced, False, packed=True)
+        body.drain()  # hash of the whole file
+        print "You uploaded %s (%d bytes)." % (filename, body.count)
+        cache_key = parse_cache.key(body.hexdigest(), *settings)
+        jsondata = parse_cache.get(cache_key)
+        if jsondata is not None:
+            print "Returning cached import result."
+        else:
+            if optimize:
+                optimize_all(res['boundarys'], TOLERANCE, improve_steps, optimize_pool)
+            unpack_boundarys(res['boundarys'])
+            jsondata = json.dumps(res)
+            parse_cache.put(cache_key, jsondata)
+        if file_key:
+            parse_cache.put(file_key, jsondata)
+        return jsondata
+    return "You missed a field."
+
+
 # @route('/svg_reader', method='POST')
 # def svg_upload():
 #     """Parse SVG string."""
@@ -507,7 +761,12 @@ argparser.add_argument('--raspberrypi', dest='raspberrypi', action='store_true',
                     default=False, help='use this for running on Raspberry Pi')
 argparser.add_argument('-m', '--match', dest='match',
                     default=GUESS_PREFIX, help='match serial device with this string')                                        
+argparser.add_argument('--server', dest='server_mode', choices=['single', 'threaded'],
+                    default='threaded', help='serve requests one at a time or from a thread pool (default: threaded)')
+argparser.add_argument('--optimize-processes', dest='optimize_processes', type=int, default=OPTIMIZE_PROCESSES,
+                    help='worker processes for optimizing imports, 0 for one per cpu (default: 1, no workers)')
 args = argparser.parse_args()
+OPTIMIZE_PROCESSES = args.optimize_processes or None
 
 
 
@@ -649,9 +908,9 @@ else:
             print "ERROR: Failed to flash Arduino."
     else:
         if args.host_on_all_interfaces:
-            run_with_callback('', NETWORK_PORT)
+            run_with_callback('', NETWORK_PORT, args.server_mode)
         else:
-            run_with_callback('127.0.0.1', NETWORK_PORT)    
+            run_with_callback('127.0.0.1', NETWORK_PORT, args.server_mode)    
 
         
 
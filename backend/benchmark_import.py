@@ -0,0 +1,472 @@
+"""
+Benchmark for the SVG/DXF import pipeline.
+
+Runs filereaders.read_svg/read_dxf (including optimize_all) on a corpus
+of generated files plus any SVG/DXF files found in the library and
+reports per-stage timing, peak memory and vertex counts.
+
+Usage (from the backend directory):
+python benchmark_import.py                  # run and compare to baseline
+python benchmark_import.py --save           # run and store as baseline
+python benchmark_import.py --scale 4 --case many_small_paths
+python benchmark_import.py some.svg other.dxf
+
+Each case runs in its own process so peak memory is per case.
+"""
+
+import os
+import sys
+import time
+import json
+import glob
+import random
+import argparse
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None  # windows, no peak memory
+
+import filereaders
+from filereaders import svg_reader, svg_tag_reader, svg_attribute_reader
+from filereaders import svg_path_reader, dxf_reader, path_optimizers, flatten
+
+
+TARGET_SIZE = [1220, 610]
+TOLERANCE = 0.08
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmark_import_baseline.json')
+REGRESSION_THRESHOLD = 1.2  # report stages 20% slower than baseline
+
+# stage name by (module, class name or None, function name)
+# Time spent in a function counts towards its stage excluding time
+# spent in nested stages. Missing functions are skipped.
+STAGES = [
+    (svg_reader, 'SVGReader', 'parse', 'xml parse'),
+    (svg_reader, 'SVGReader', 'read_tag', 'transform'),
+    (svg_tag_reader, 'SVGTagReader', 'read_tag', 'tags'),
+    (svg_attribute_reader, 'SVGAttributeReader', 'read_attrib', 'attributes'),
+    (svg_path_reader, 'SVGPathReader', 'add_path', 'tessellation'),
+    (dxf_reader, 'DXFReader', 'parse', 'dxf read'),
+    (flatten, None, 'cubic', 'tessellation'),
+    (flatten, None, 'quadratic', 'tessellation'),
+    (flatten, None, 'arc', 'tessellation'),
+    (flatten, None, 'spline', 'tessellation'),
+    (path_optimizers, None, 'join_segments', 'join'),
+    (path_optimizers, None, 'simplify_all', 'simplify'),
+    (path_optimizers, None, 'sort_by_seektime', 'sort'),
+    (path_optimizers, None, 'improve_seektime', 'sequence'),
+]
+
+
+
+class StageTimer:
+    """Exclusive wall time per stage by wrapping functions."""
+
+    def __init__(self):
+        self.times = {}
+        self._stack = []    # [stage, resumed_at]
+        self._patched = []
+
+    def install(self, stages):
+        for module, class_name, func_name, stage in stages:
+            owner = module
+            if class_name:
+                owner = getattr(module, class_name, None)
+            if owner is not None and hasattr(owner, func_name):
+                self._wrap(owner, func_name, stage)
+
+    def uninstall(self):
+        for owner, func_name, func in reversed(self._patched):
+            setattr(owner, func_name, func)
+        self._patched = []
+
+    def _wrap(self, owner, func_name, stage):
+        func = getattr(owner, func_name)
+        timer = self
+        def wrapper(*args, **kwargs):
+            timer._enter(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer._exit()
+        setattr(owner, func_name, wrapper)
+        self._patched.append((owner, func_name, func))
+
+    def _charge(self, now):
+        top = self._stack[-1]
+        self.times[top[0]] = self.times.get(top[0], 0.0) + now - top[1]
+
+    def _enter(self, stage):
+        now = time.time()
+        if self._stack:
+            self._charge(now)
+        self._stack.append([stage, now])
+
+    def _exit(self):
+        now = time.time()
+        self._charge(now)
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1][1] = now
+
+
+
+### corpus
+
+def _svg(body, w=1220, h=610):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" width="%dmm" height="%dmm">\n'
+            '%s\n</svg>\n' % (w, h, body))
+
+def gen_many_small_paths(scale, rnd):
+    colors = ['#ff0000', '#00ff00', '#0000ff']
+    items = []
+    for i in xrange(int(5000*scale)):
+        x = rnd.uniform(0, 1200)
+        y = rnd.uniform(0, 600)
+        if i % 2:
+            items.append('<rect x="%.3f" y="%.3f" width="4" height="3" stroke="%s" fill="none"/>'
+                         % (x, y, colors[i % 3]))
+        else:
+            items.append('<path d="M%.3f,%.3f l2,1 l1,2 l-3,0 z" stroke="%s" fill="none"/>'
+                         % (x, y, colors[i % 3]))
+    return _svg('\n'.join(items))
+
+def gen_huge_path(scale, rnd):
+    d = ['M10,300']
+    for i in xrange(int(20000*scale)):
+        d.append('c%.3f,%.3f %.3f,%.3f %.3f,%.3f' % (
+            rnd.uniform(-5, 5), rnd.uniform(-5, 5), rnd.uniform(-5, 5),
+            rnd.uniform(-5, 5), rnd.uniform(-0.05, 0.1), rnd.uniform(-0.1, 0.1)))
+    return _svg('<path d="%s" stroke="#000000" fill="none"/>' % ' '.join(d))
+
+def gen_deep_nesting(scale, rnd):
+    depth = int(150*min(scale, 4))
+    body = []
+    for i in xrange(depth):
+        body.append('<g transform="translate(%.3f,%.3f)">' % (rnd.uniform(0, 2), rnd.uniform(0, 1)))
+        for j in xrange(int(20*scale)):
+            body.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="#000000"/>'
+                        % (j, 0, j+1, 1))
+    body.append('</g>'*depth)
+    return _svg('\n'.join(body))
+
+def gen_heavy_transforms(scale, rnd):
+    items = []
+    for i in xrange(int(2000*scale)):
+        xform = 'translate(%.2f,%.2f) rotate(%.1f) scale(%.2f) skewX(%.1f) matrix(1,0.1,0,1,3,4)' % (
+            rnd.uniform(0, 1000), rnd.uniform(0, 500), rnd.uniform(0, 360),
+            rnd.uniform(0.5, 2), rnd.uniform(-20, 20))
+        items.append('<g transform="%s"><circle cx="0" cy="0" r="%.2f" stroke="#000000"/>'
+                     '<ellipse cx="5" cy="5" rx="3" ry="1" stroke="#ff0000"/></g>'
+                     % (xform, rnd.uniform(1, 20)))
+    return _svg('\n'.join(items))
+
+def gen_svg_uses(scale, rnd):
+    # a sheet of nested parts, each part defined once
+    parts = []
+    for p in xrange(5):
+        d = ['M0,0']
+        for i in xrange(40):
+            d.append('c%.3f,%.3f %.3f,%.3f %.3f,%.3f' % (
+                rnd.uniform(-5, 5), rnd.uniform(-5, 5), rnd.uniform(-5, 5),
+                rnd.uniform(-5, 5), rnd.uniform(-2, 2), rnd.uniform(-2, 2)))
+        parts.append('<symbol id="part%d"><path d="%s z"/><circle cx="3" cy="3" r="2"/></symbol>'
+                     % (p, ' '.join(d)))
+    items = ['<defs>%s</defs>' % ''.join(parts)]
+    for i in xrange(int(3000*scale)):
+        items.append('<use xlink:href="#part%d" transform="translate(%.2f,%.2f) rotate(%.1f)" stroke="#000000"/>'
+                     % (rnd.randint(0, 4), rnd.uniform(0, 1200), rnd.uniform(0, 600), rnd.choice([0, 90, 180, 270])))
+    return _svg('\n'.join(items)).replace('<svg ', '<svg xmlns:xlink="http://www.w3.org/1999/xlink" ', 1)
+
+def _dxf(entities, blocks=''):
+    if blocks:
+        blocks = '0\nSECTION\n2\nBLOCKS\n%s0\nENDSEC\n' % blocks
+    return '%s0\nSECTION\n2\nENTITIES\n%s0\nENDSEC\n0\nEOF\n' % (blocks, ''.join(entities))
+
+def gen_dxf_lines(scale, rnd):
+    # chains of line segments in random order, as exported by many CAD apps
+    entities = []
+    for c in xrange(int(200*scale)):
+        x = rnd.uniform(0, 1000)
+        y = rnd.uniform(0, 500)
+        for s in xrange(25):
+            x2 = x + rnd.uniform(-5, 5)
+            y2 = y + rnd.uniform(-5, 5)
+            entities.append('0\nLINE\n8\n0\n10\n%f\n20\n%f\n11\n%f\n21\n%f\n' % (x, y, x2, y2))
+            x, y = x2, y2
+    rnd.shuffle(entities)
+    return _dxf(entities)
+
+def gen_dxf_arcs(scale, rnd):
+    entities = []
+    for i in xrange(int(3000*scale)):
+        x = rnd.uniform(0, 1000)
+        y = rnd.uniform(0, 500)
+        r = rnd.uniform(0.5, 50)
+        if i % 2:
+            entities.append('0\nCIRCLE\n8\n0\n10\n%f\n20\n%f\n40\n%f\n' % (x, y, r))
+        else:
+            entities.append('0\nARC\n8\n0\n10\n%f\n20\n%f\n40\n%f\n50\n%f\n51\n%f\n'
+                            % (x, y, r, rnd.uniform(0, 360), rnd.uniform(0, 360)))
+    return _dxf(entities)
+
+def gen_dxf_lwpolylines(scale, rnd):
+    entities = []
+    for i in xrange(int(1000*scale)):
+        n = 50
+        verts = []
+        x = rnd.uniform(0, 1000)
+        y = rnd.uniform(0, 500)
+        for j in xrange(n):
+            x += rnd.uniform(-2, 2)
+            y += rnd.uniform(-2, 2)
+            verts.append('10\n%f\n20\n%f\n' % (x, y))
+        entities.append('0\nLWPOLYLINE\n8\n0\n90\n%d\n70\n0\n%s' % (n, ''.join(verts)))
+    return _dxf(entities)
+
+def gen_dxf_curves(scale, rnd):
+    # bulged lwpolylines and cubic splines
+    entities = []
+    for i in xrange(int(500*scale)):
+        x = rnd.uniform(0, 1000)
+        y = rnd.uniform(0, 500)
+        verts = []
+        for j in xrange(10):
+            verts.append('10\n%f\n20\n%f\n42\n%f\n' % (
+                x + rnd.uniform(-20, 20), y + rnd.uniform(-20, 20), rnd.uniform(-1.5, 1.5)))
+        entities.append('0\nLWPOLYLINE\n8\n0\n90\n10\n70\n1\n%s' % ''.join(verts))
+        n = 12
+        knots = [0]*4 + range(1, n-3) + [n-3]*4
+        points = ['10\n%f\n20\n%f\n' % (x + 5*j, y + rnd.uniform(-20, 20)) for j in xrange(n)]
+        entities.append('0\nSPLINE\n8\n0\n70\n8\n71\n3\n72\n%d\n73\n%d\n%s%s' % (
+            len(knots), n, ''.join('40\n%d\n' % k for k in knots), ''.join(points)))
+    return _dxf(entities)
+
+def gen_dxf_blocks(scale, rnd):
+    # a few parts inserted many times, some as arrays
+    blocks = []
+    for b in xrange(5):
+        ents = ['0\nCIRCLE\n8\n0\n10\n%f\n20\n%f\n40\n%f\n' % (
+            rnd.uniform(0, 20), rnd.uniform(0, 20), rnd.uniform(1, 10)) for i in xrange(10)]
+        ents.append('0\nLWPOLYLINE\n8\n0\n90\n4\n70\n1\n10\n0\n20\n0\n10\n20\n20\n0\n42\n0.5\n'
+                    '10\n20\n20\n20\n10\n0\n20\n20\n')
+        blocks.append('0\nBLOCK\n2\nPART%d\n70\n0\n10\n10\n20\n10\n%s0\nENDBLK\n' % (b, ''.join(ents)))
+    entities = []
+    for i in xrange(int(400*scale)):
+        entities.append('0\nINSERT\n8\n0\n2\nPART%d\n10\n%f\n20\n%f\n50\n%f\n70\n%d\n71\n%d\n44\n25\n45\n25\n' % (
+            rnd.randint(0, 4), rnd.uniform(0, 1000), rnd.uniform(0, 500), rnd.uniform(0, 360),
+            rnd.randint(1, 3), rnd.randint(1, 2)))
+    return _dxf(entities, ''.join(blocks))
+
+GENERATORS = [
+    ('many_small_paths', '.svg', gen_many_small_paths),
+    ('huge_path', '.svg', gen_huge_path),
+    ('deep_nesting', '.svg', gen_deep_nesting),
+    ('heavy_transforms', '.svg', gen_heavy_transforms),
+    ('svg_uses', '.svg', gen_svg_uses),
+    ('dxf_lines', '.dxf', gen_dxf_lines),
+    ('dxf_arcs', '.dxf', gen_dxf_arcs),
+    ('dxf_lwpolylines', '.dxf', gen_dxf_lwpolylines),
+    ('dxf_curves', '.dxf', gen_dxf_curves),
+    ('dxf_blocks', '.dxf', gen_dxf_blocks),
+]
+
+
+def library_files():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../library')
+    files = []
+    for ext in ['svg', 'SVG', 'dxf', 'DXF']:
+        files.extend(glob.glob(os.path.join(root, '*.' + ext)))
+    return sorted(files)
+
+
+def load_case(name, scale, files):
+    """Return (filedata, is_dxf) for a corpus case or file path."""
+    for case_name, ext, generator in GENERATORS:
+        if case_name == name:
+            return generator(scale, random.Random(name)), ext == '.dxf'
+    for path in files:
+        if name == os.path.basename(path):
+            fp = open(path)
+            try:
+                return fp.read(), path.lower().endswith('.dxf')
+            finally:
+                fp.close()
+    raise ValueError("unknown case: " + name)
+
+
+
+### running
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024  # bytes on OSX
+    return peak
+
+def _count(boundarys):
+    paths = 0
+    verts = 0
+    for color in boundarys:
+        for path in boundarys[color]:
+            paths += 1
+            verts += len(path)/2
+    return paths, verts
+
+
+def _seek(boundarys):
+    total = 0.0
+    for color in boundarys:
+        total += path_optimizers.seek_distance(boundarys[color])
+    return total
+
+
+def run_case(name, scale, files, optimize=True, improve_steps=0, pool=None):
+    """Run one case in this process, return a result dict."""
+    filedata, is_dxf = load_case(name, scale, files)
+    rss_before = _peak_rss_kb()
+    # vertex count before optimizing
+    if is_dxf:
+        raw = filereaders.read_dxf(filedata, TOLERANCE, False, packed=True)
+    else:
+        raw = filereaders.read_svg(filedata, TARGET_SIZE, TOLERANCE, None, False, packed=True)
+    raw_paths, raw_verts = _count(raw['boundarys'])
+    raw = None
+    timer = StageTimer()
+    timer.install(STAGES)
+    try:
+        t = time.time()
+        if is_dxf:
+            res = filereaders.read_dxf(filedata, TOLERANCE, optimize, improve_steps,
+                                       packed=True, pool=pool)
+        else:
+            res = filereaders.read_svg(filedata, TARGET_SIZE, TOLERANCE, None, optimize,
+                                       improve_steps, packed=True, pool=pool)
+        total = time.time() - t
+    finally:
+        timer.uninstall()
+    paths, verts = _count(res['boundarys'])
+    peak = None
+    if rss_before is not None:
+        peak = _peak_rss_kb() - rss_before
+    return {
+        'name': name,
+        'bytes': len(filedata),
+        'total': total,
+        'stages': timer.times,
+        'paths_in': raw_paths,
+        'vertices_in': raw_verts,
+        'paths_out': paths,
+        'vertices_out': verts,
+        'seek': _seek(res['boundarys']),
+        'peak_kb': peak
+    }
+
+
+def run_case_subprocess(name, scale, files, improve_steps=0, processes=1):
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-case', name,
+           '--scale', str(scale), '--improve', str(improve_steps),
+           '--processes', str(processes)] + files
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError("case %s failed" % name)
+    return json.loads(out.splitlines()[-1])
+
+
+
+### reporting
+
+def print_result(res, base=None):
+    peak = '-'
+    if res['peak_kb'] is not None:
+        peak = '%.1fMB' % (res['peak_kb']/1024.0)
+    flag = ''
+    if base and res['total'] > REGRESSION_THRESHOLD*base['total']:
+        flag = '  << REGRESSION (baseline %.3fs)' % base['total']
+    seek = ''
+    if 'seek' in res:
+        seek = '  seek %.0fmm' % res['seek']
+        if base and base.get('seek'):
+            seek += ' (x%.2f)' % (res['seek']/base['seek'])
+    print "%-20s %8.3fs  %9d bytes  paths %d->%d  verts %d->%d%s  peak +%s%s" % (
+        res['name'], res['total'], res['bytes'], res['paths_in'], res['paths_out'],
+        res['vertices_in'], res['vertices_out'], seek, peak, flag)
+    for stage in sorted(res['stages'], key=lambda s: -res['stages'][s]):
+        t = res['stages'][stage]
+        line = "    %-16s %8.3fs" % (stage, t)
+        if base and stage in base['stages'] and base['stages'][stage] > 0:
+            ratio = t/base['stages'][stage]
+            line += "  x%.2f" % ratio
+            if ratio > REGRESSION_THRESHOLD and t > 0.01:
+                line += "  << REGRESSION"
+        print line
+
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Benchmark the SVG/DXF import pipeline.')
+    argparser.add_argument('files', nargs='*', help='additional SVG/DXF files')
+    argparser.add_argument('--case', action='append', dest='cases',
+                           help='run only this case (repeatable)')
+    argparser.add_argument('--scale', type=float, default=1.0,
+                           help='size factor for the generated corpus')
+    argparser.add_argument('--improve', type=int, default=0,
+                           help='steps for refining the path order (optimize_all improve_steps)')
+    argparser.add_argument('--processes', type=int, default=1,
+                           help='optimize_all worker processes, 0 for one per cpu '
+                                '(stage times then only cover the main process)')
+    argparser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                           help='baseline file to compare with (and --save to)')
+    argparser.add_argument('--save', action='store_true', default=False,
+                           help='store results as the new baseline')
+    argparser.add_argument('--inline', action='store_true', default=False,
+                           help='run all cases in this process (no peak memory per case)')
+    argparser.add_argument('--run-case', dest='run_case', help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    files = [os.path.abspath(f) for f in args.files] + library_files()
+    pool = None
+    if args.run_case or args.inline:
+        pool = filereaders.make_pool(args.processes or None)
+
+    if args.run_case:
+        # child process mode, result as json on the last line
+        print json.dumps(run_case(args.run_case, args.scale, files,
+                                     improve_steps=args.improve, pool=pool))
+        sys.exit(0)
+
+    names = args.cases or ([g[0] for g in GENERATORS] + [os.path.basename(f) for f in files])
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        fp = open(args.baseline)
+        try:
+            baseline = json.load(fp)
+        finally:
+            fp.close()
+        if baseline.get('scale') != args.scale:
+            print "Baseline is for scale %s, not comparing." % baseline.get('scale')
+            baseline = {}
+
+    results = {}
+    for name in names:
+        if args.inline:
+            res = run_case(name, args.scale, files, improve_steps=args.improve,
+                           pool=pool)
+        else:
+            res = run_case_subprocess(name, args.scale, files, args.improve, args.processes)
+        results[name] = res
+        print_result(res, baseline.get('cases', {}).get(name))
+
+    if args.save:
+        fp = open(args.baseline, 'w')
+        try:
+            json.dump({'scale': args.scale, 'cases': results}, fp, indent=1)
+        finally:
+            fp.close()
+        print "Baseline saved to " + args.baseline
@@ -8,23 +8,33 @@ __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 
 from .svg_reader import SVGReader
 from .dxf_reader import DXFReader
-from .path_optimizers import optimize_all
+from .path_optimizers import optimize_all, make_pool
 
 
-def read_svg(svg_string, target_size, tolerance, forced_dpi=None, optimize=True):
+def unpack_boundarys(boundarys):
+    """Convert packed [x0,y0,x1,y1,..] paths to [[x0,y0],[x1,y1],..] in-place."""
+    for color in boundarys:
+        boundarys[color] = [map(list, zip(path[0::2], path[1::2])) for path in boundarys[color]]
+
+
+def read_svg(svg_string, target_size, tolerance, forced_dpi=None, optimize=True, improve_steps=0, packed=False, pool=None):
     svgReader = SVGReader(tolerance, target_size)
     parse_results = svgReader.parse(svg_string, forced_dpi)
     if optimize:
-        optimize_all(parse_results['boundarys'], tolerance)
+        optimize_all(parse_results['boundarys'], tolerance, improve_steps, pool)
+    if not packed:
+        unpack_boundarys(parse_results['boundarys'])
     # {'boundarys':b, 'dpi':d, 'lasertags':l}
     return parse_results
 
 
-def read_dxf(dxf_string, tolerance, optimize=True):
+def read_dxf(dxf_string, tolerance, optimize=True, improve_steps=0, packed=False, pool=None):
     dxfReader = DXFReader(tolerance)
     parse_results = dxfReader.parse(dxf_string)
     if optimize:
-        optimize_all(parse_results['boundarys'], tolerance)
+        optimize_all(parse_results['boundarys'], tolerance, improve_steps, pool)
+    if not packed:
+        unpack_boundarys(parse_results['boundarys'])
     # # flip y-axis
     # for color,paths in parse_results['boundarys'].items():
     # 	for path in paths:
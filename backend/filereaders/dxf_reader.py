@@ -9,13 +9,24 @@ __author__ = 'David S. Touretzky, Stefan Hechenberger <stefan@nortd.com>'
 import math
 import sys
 import os.path
-import StringIO
+import cStringIO
+from array import array
 
+from . import flatten
+from .utilities import matrixApply
+
+
+CHUNK_SIZE = 1024*1024  # bytes read at a time
+
+
+class DXFError(ValueError):
+    """Invalid DXF input, already reported."""
+    pass
 
 
 
 class DXFReader:
-    """Parse very simple DXF files with lines, arcs, and lwpolyline.
+    """Parse simple DXF files with lines, arcs, polylines and splines.
 
     Usage:
     reader = DXFReader(0.08)
@@ -29,21 +40,68 @@ class DXFReader:
 
         # parsed path data, paths by color
         # {'#ff0000': [[path0, path1, ..], [path0, ..], ..]}
-        # Each path is a list of vertices which is a list of two floats.        
+        # Each path is a packed array('d') of vertex coordinates [x0,y0,x1,y1,...].
         self.boundarys = {'#000000':[]}
         self.black_boundarys = self.boundarys['#000000']
 
+        # where entity handlers add their paths, black_boundarys
+        # or the paths of the block being flattened
+        self.paths = self.black_boundarys
+        # scale of the block being flattened relative to the output,
+        # self.tolerance is divided by it
+        self.scale = 1.0
+
+        # block definitions by name
+        # {'name': {'base': (x, y), 'groups': [(entity, pairs, line), ..]}}
+        self.blocks = {}
+        # flattened block paths in block coordinates
+        # by (name, scale bucket)
+        self.block_cache = {}
+        self.expanding = set()  # blocks being flattened, against cycles
+
+        # unsupported entities, counts by type
+        self.skipped = {}
+
         self.metricflag = 1
         self.linecount = 0
-        self.line = ''
-        self.dxfcode = ''
+
+        # POLYLINE being read from VERTEX entities until SEQEND
+        # as [closed, [(x, y, bulge), ..]], None otherwise
+        self.polyline = None
+
+        # entity handlers by entity type, called with the
+        # entity's (code, value) pairs
+        self.entity_handlers = {
+            'LINE': self.do_line,
+            'CIRCLE': self.do_circle,
+            'ARC': self.do_arc,
+            'LWPOLYLINE': self.do_lwpolyline,
+            'POLYLINE': self.do_polyline,
+            'VERTEX': self.do_vertex,
+            'SEQEND': self.do_seqend,
+            'SPLINE': self.do_spline,
+            'INSERT': self.do_insert,
+        }
 
 
 
     def parse(self, dxfstring):
+        """Parse a DXF document, dxfstring may also be a file object.
+
+        The file is read in chunks and split into (code, value) pairs
+        in bulk. Entities of the ENTITIES section get dispatched by
+        type to self.entity_handlers, unsupported ones are skipped.
+        Blocks are kept unflattened until inserted.
+        """
         self.linecount = 0
-        self.line = ""
-        self.infile = StringIO.StringIO(dxfstring)
+        self.polyline = None
+        self.blocks = {}
+        self.block_cache = {}
+        self.skipped = {}
+        if hasattr(dxfstring, 'read'):
+            infile = dxfstring
+        else:
+            infile = cStringIO.StringIO(dxfstring)
 
         # assume metric file for now
         # self.readtosection(9, "$MEASUREMENT")
@@ -57,93 +115,174 @@ class DXFReader:
         #         self.metricflag = 1
         self.metricflag = 1
 
-        self.readtosection(2, "ENTITIES")
-        while 1:
-            self.readtocode(0)
-            if self.line == "LINE": self.do_line()
-            elif self.line == "CIRCLE": self.do_circle()
-            elif self.line == "ARC": self.do_arc()
-            elif self.line == "LWPOLYLINE": self.do_lwpolyline()
-            elif self.line == "SPLINE": self.complain_spline()
-            elif self.line == "ENDSEC": break
-            else: self.complain_invalid()
-
-        self.infile.close()
+        section = None
+        block = None
+        done = False
+        for name, pairs in self.read_groups(infile):
+            if name == 'SECTION':
+                section = dict(pairs).get(2)
+            elif name == 'ENDSEC':
+                if section == 'ENTITIES':
+                    done = True
+                    break
+                section = None
+            elif section == 'ENTITIES':
+                self.dispatch(name, pairs)
+            elif section == 'BLOCKS':
+                if name == 'BLOCK':
+                    groups = dict(pairs)
+                    block = {'base': (float(groups.get(10, 0.0)), float(groups.get(20, 0.0))),
+                             'groups': []}
+                    self.blocks[groups.get(2)] = block
+                elif name == 'ENDBLK':
+                    block = None
+                elif block is not None:
+                    block['groups'].append((name, pairs, self.linecount))
+        if not done:
+            print "Premature end of file!"
+            print "Something is wrong. Sorry!"
+            raise DXFError
+
+        for name in sorted(self.skipped):
+            print "Skipped %d unsupported %s entities." % (self.skipped[name], name)
         print "Done!"
         return {'boundarys':self.boundarys}
 
 
     ################
-    # Routines to read entries from the DXF file
-
-    def readtosection(self, codeval, stringval):
-        self.dxfcode = None
-        while (self.dxfcode != codeval) or (self.line != stringval):
-            self.readonepair()
-
-    def readonepair(self):
-        self.readoneline()
-        self.dxfcode = int(self.line)
-        self.readoneline()
-
-    def readoneline(self):
-        self.linecount += 1
-        self.line = self.infile.readline()
-        if not self.line: 
-            print "Premature end of file!"
-            print "Something is wrong. Sorry!"
-            raise ValueError
-        self.line = self.line.rstrip()
-
-    def readtocode(self, val):
-        self.dxfcode = None
-        while self.dxfcode != val:
-            self.readonepair()
+    # Read the DXF file as groups of (code, value) pairs
+
+    def read_groups(self, infile):
+        """Generate (name, pairs) for every 0 code in infile.
+
+        pairs are the (code, value) tuples following the 0 code up
+        to the next one. Codes are ints, values right-stripped strings.
+        self.linecount is the line of the group's 0 code.
+        """
+        rest = ''
+        code_cache = {}
+        paircount = 0  # pairs before codes[0]
+        name = None  # of the group being read
+        pending_codes = []
+        pending_values = []
+        while 1:
+            chunk = infile.read(CHUNK_SIZE)
+            if chunk:
+                lines = (rest + chunk).split('\n')
+                rest = lines.pop()  # partial line
+                if len(lines) % 2:
+                    rest = lines.pop() + '\n' + rest
+            else:
+                lines = rest.split('\n')
+                rest = ''
+                if not lines[-1].strip():
+                    lines.pop()
+                if len(lines) % 2:
+                    print "Premature end of file!"
+                    print "Something is wrong. Sorry!"
+                    raise DXFError
+            if not lines:
+                if not chunk:
+                    break
+                continue
+            # few distinct code lines, look them up instead of int()
+            codelines = lines[0::2]
+            codes = map(code_cache.get, codelines)
+            if None in codes:
+                for k in xrange(len(codes)):
+                    if codes[k] is None:
+                        try:
+                            codes[k] = code_cache[codelines[k]] = int(codelines[k])
+                        except ValueError:
+                            print "Invalid group code on line", 2*(paircount+k)+1
+                            raise DXFError
+            codelines = None
+            values = map(str.rstrip, lines[1::2])
+            lines = None
+            # split at 0 codes, C-level searches via list.index
+            i = 0
+            n = len(codes)
+            while i < n:
+                try:
+                    j = codes.index(0, i)
+                except ValueError:
+                    j = n
+                if name is not None:
+                    pending_codes.extend(codes[i:j])
+                    pending_values.extend(values[i:j])
+                    if j < n:
+                        yield name, zip(pending_codes, pending_values)
+                        pending_codes = []
+                        pending_values = []
+                if j < n:
+                    name = values[j]
+                    self.linecount = 2*(paircount+j)+1
+                    i = j+1
+                else:
+                    i = n
+            paircount += n
+            if not chunk:
+                break
+        if name is not None:
+            yield name, zip(pending_codes, pending_values)
+
+    def dispatch(self, name, pairs):
+        """Call the handler of an entity."""
+        handler = self.entity_handlers.get(name)
+        if handler is None:
+            self.skipped[name] = self.skipped.get(name, 0) + 1
+            return
+        try:
+            handler(pairs)
+        except DXFError:
+            raise
+        except (KeyError, ValueError, IndexError):
+            self.complain_invalid(name)
 
-    def readgroup(self, codeval):
-        self.readtocode(codeval)
-        return self.line
 
     ################
     # Translate each type of entity (line, circle, arc, lwpolyline)
 
-    def do_line(self):
-        x1 = float(self.readgroup(10))
-        y1 = float(self.readgroup(20))
-        x2 = float(self.readgroup(11))
-        y2 = float(self.readgroup(21))
+    def do_line(self, pairs):
+        groups = dict(pairs)
+        x1 = float(groups[10])
+        y1 = float(groups[20])
+        x2 = float(groups[11])
+        y2 = float(groups[21])
         if self.metricflag == 0:
             x1 = x1*25.4
             y1 = y1*25.4        
             x2 = x2*25.4
             y2 = y2*25.4        
-        self.black_boundarys.append([[x1,y1],[x2,y2]])
+        self.paths.append(array('d', (x1,y1,x2,y2)))
 
-    def do_circle(self):
-        cx = float(self.readgroup(10))
-        cy = float(self.readgroup(20))
-        r = float(self.readgroup(40))
+    def do_circle(self, pairs):
+        groups = dict(pairs)
+        cx = float(groups[10])
+        cy = float(groups[20])
+        r = float(groups[40])
         if self.metricflag == 0:
             cx = cx*25.4
             cy = cy*25.4        
             r = r*25.4  
-        path = []
-        self.addArc(path, cx-r, cy, r, r, 0, 0, 0, cx, cy+r)
-        self.addArc(path, cx, cy+r, r, r, 0, 0, 0, cx+r, cy)
-        self.addArc(path, cx+r, cy, r, r, 0, 0, 0, cx, cy-r)
-        self.addArc(path, cx, cy-r, r, r, 0, 0, 0, cx-r, cy)
-        self.black_boundarys.append(path)
-
-    def do_arc(self):
-        cx = float(self.readgroup(10))
-        cy = float(self.readgroup(20))
-        r = float(self.readgroup(40))
+        path = array('d')
+        flatten.arc(path, cx-r, cy, r, r, 0, 0, 0, cx, cy+r, self.tolerance)
+        flatten.arc(path, cx, cy+r, r, r, 0, 0, 0, cx+r, cy, self.tolerance)
+        flatten.arc(path, cx+r, cy, r, r, 0, 0, 0, cx, cy-r, self.tolerance)
+        flatten.arc(path, cx, cy-r, r, r, 0, 0, 0, cx-r, cy, self.tolerance)
+        self.paths.append(path)
+
+    def do_arc(self, pairs):
+        groups = dict(pairs)
+        cx = float(groups[10])
+        cy = float(groups[20])
+        r = float(groups[40])
         if self.metricflag == 0:
             cx = cx*25.4
             cy = cy*25.4        
             r = r*25.4        
-        theta1deg = float(self.readgroup(50))
-        theta2deg = float(self.readgroup(51))
+        theta1deg = float(groups[50])
+        theta2deg = float(groups[51])
         thetadiff = theta2deg-theta1deg
         if thetadiff < 0 : thetadiff = thetadiff + 360
         large_arc_flag = int(thetadiff >= 180)
@@ -154,110 +293,171 @@ class DXFReader:
         y1 = cy + r*math.sin(theta1)
         x2 = cx + r*math.cos(theta2)
         y2 = cy + r*math.sin(theta2)
-        path = []
-        self.addArc(path, x1, y1, r, r, 0, large_arc_flag, sweep_flag, x2, y2)
-        self.black_boundarys.append(path)
-
-    def do_lwpolyline(self):
-        numverts = int(self.readgroup(90))
-        path = []
-        self.black_boundarys.append(path)
-        for i in range(0,numverts):
-            x = float(self.readgroup(10))
-            y = float(self.readgroup(20))
+        path = array('d')
+        flatten.arc(path, x1, y1, r, r, 0, large_arc_flag, sweep_flag, x2, y2, self.tolerance)
+        self.paths.append(path)
+
+    def do_lwpolyline(self, pairs):
+        # vertices as 10/20 pairs in order, 42 is the bulge
+        # of the segment starting at the preceding vertex
+        vertices = []
+        closed = False
+        for code, value in pairs:
+            if code == 10:
+                vertices.append([float(value), 0.0, 0.0])
+            elif code == 20:
+                vertices[-1][1] = float(value)
+            elif code == 42:
+                vertices[-1][2] = float(value)
+            elif code == 70:
+                closed = bool(int(value) & 1)
+        self.paths.append(self.polyline_path(vertices, closed))
+
+    def do_polyline(self, pairs):
+        flags = int(dict(pairs).get(70, 0))
+        if flags & (16 | 64):
+            # polygon and polyface meshes are not supported
+            self.polyline = None
+            return
+        self.polyline = [bool(flags & 1), []]
+
+    def do_vertex(self, pairs):
+        if self.polyline is None:
+            return
+        groups = dict(pairs)
+        if int(groups.get(70, 0)) & 16:
+            return  # spline frame control point, not on the curve
+        self.polyline[1].append((float(groups[10]), float(groups[20]),
+                                 float(groups.get(42, 0.0))))
+
+    def do_seqend(self, pairs):
+        # also ends the attributes of INSERT entities
+        if self.polyline is not None:
+            closed, vertices = self.polyline
+            self.polyline = None
+            self.paths.append(self.polyline_path(vertices, closed))
+
+    def do_spline(self, pairs):
+        degree = 3
+        closed = False
+        knots = []
+        weights = []
+        points = array('d')
+        fitpoints = array('d')
+        for code, value in pairs:
+            if code == 10 or code == 20:
+                points.append(float(value))
+            elif code == 11 or code == 21:
+                fitpoints.append(float(value))
+            elif code == 40:
+                knots.append(float(value))
+            elif code == 41:
+                weights.append(float(value))
+            elif code == 70:
+                closed = bool(int(value) & 1)
+            elif code == 71:
+                degree = int(value)
+        if points:
+            path = array('d')
+            flatten.spline(path, degree, knots, points, weights or None, self.tolerance)
             if self.metricflag == 0:
-                x = x*25.4
-                y = y*25.4
-            path.append([x,y])
-
-    def complain_spline(self):
-        print "Encountered a SPLINE at line", self.linecount
-        print "This program cannot handle splines at present."
-        print "Convert the spline to an LWPOLYLINE using Save As options in SolidWorks."
-        raise ValueError
-
-    def complain_invalid(self):
-        print "Invalid element '" + self.line + "' on line", self.linecount
-        print "Can't process this DXF file. Sorry!"
-        raise ValueError
-
-    def addArc(self, path, x1, y1, rx, ry, phi, large_arc, sweep, x2, y2):
-        # Implemented based on the SVG implementation notes
-        # plus some recursive sugar for incrementally refining the
-        # arc resolution until the requested tolerance is met.
-        # http://www.w3.org/TR/SVG/implnote.html#ArcImplementationNotes
-        cp = math.cos(phi)
-        sp = math.sin(phi)
-        dx = 0.5 * (x1 - x2)
-        dy = 0.5 * (y1 - y2)
-        x_ = cp * dx + sp * dy
-        y_ = -sp * dx + cp * dy
-        r2 = ((rx*ry)**2-(rx*y_)**2-(ry*x_)**2) / ((rx*y_)**2+(ry*x_)**2)
-        if r2 < 0:
-            r2 = 0
-        r = math.sqrt(r2)
-        if large_arc == sweep:
-            r = -r
-        cx_ = r*rx*y_ / ry
-        cy_ = -r*ry*x_ / rx
-        cx = cp*cx_ - sp*cy_ + 0.5*(x1 + x2)
-        cy = sp*cx_ + cp*cy_ + 0.5*(y1 + y2)
-        
-        def _angle(u, v):
-            a = math.acos((u[0]*v[0] + u[1]*v[1]) /
-                            math.sqrt(((u[0])**2 + (u[1])**2) *
-                            ((v[0])**2 + (v[1])**2)))
-            sgn = -1
-            if u[0]*v[1] > u[1]*v[0]:
-                sgn = 1
-            return sgn * a
-    
-        psi = _angle([1,0], [(x_-cx_)/rx, (y_-cy_)/ry])
-        delta = _angle([(x_-cx_)/rx, (y_-cy_)/ry], [(-x_-cx_)/rx, (-y_-cy_)/ry])
-        if sweep and delta < 0:
-            delta += math.pi * 2
-        if not sweep and delta > 0:
-            delta -= math.pi * 2
-        
-        def _getVertex(pct):
-            theta = psi + delta * pct
-            ct = math.cos(theta)
-            st = math.sin(theta)
-            return [cp*rx*ct-sp*ry*st+cx, sp*rx*ct+cp*ry*st+cy]        
-        
-        # let the recursive fun begin
-        def _recursiveArc(t1, t2, c1, c5, level, tolerance2):
-            def _vertexDistanceSquared(v1, v2):
-                return (v2[0]-v1[0])**2 + (v2[1]-v1[1])**2
-            
-            def _vertexMiddle(v1, v2):
-                return [ (v2[0]+v1[0])/2.0, (v2[1]+v1[1])/2.0 ]
-
-            if level > 18:
-                # protect from deep recursion cases
-                # max 2**18 = 262144 segments
-                return
-
-            tRange = t2-t1
-            tHalf = t1 + 0.5*tRange
-            c2 = _getVertex(t1 + 0.25*tRange)
-            c3 = _getVertex(tHalf)
-            c4 = _getVertex(t1 + 0.75*tRange)
-            if _vertexDistanceSquared(c2, _vertexMiddle(c1,c3)) > tolerance2:
-                _recursiveArc(t1, tHalf, c1, c3, level+1, tolerance2)
-            path.append(c3)
-            if _vertexDistanceSquared(c4, _vertexMiddle(c3,c5)) > tolerance2:
-                _recursiveArc(tHalf, t2, c3, c5, level+1, tolerance2)
-                
-        t1Init = 0.0
-        t2Init = 1.0
-        c1Init = _getVertex(t1Init)
-        c5Init = _getVertex(t2Init)
-        path.append(c1Init)
-        _recursiveArc(t1Init, t2Init, c1Init, c5Init, 0, self.tolerance2)
-        path.append(c5Init)
-
-
-
-
+                path = array('d', [v*25.4 for v in path])
+        else:
+            # no control points, approximate by the fit points
+            vertices = [(fitpoints[i], fitpoints[i+1], 0.0) for i in xrange(0, len(fitpoints), 2)]
+            path = self.polyline_path(vertices, closed)
+        self.paths.append(path)
+
+    def do_insert(self, pairs):
+        groups = dict(pairs)
+        name = groups[2]
+        if name not in self.blocks:
+            print "Inserted block '%s' not defined, line %d." % (name, self.linecount)
+            return
+        x = float(groups.get(10, 0.0))
+        y = float(groups.get(20, 0.0))
+        sx = float(groups.get(41, 1.0))
+        sy = float(groups.get(42, 1.0))
+        angle = math.radians(float(groups.get(50, 0.0)))
+        cols = max(int(groups.get(70, 1)), 1)
+        rows = max(int(groups.get(71, 1)), 1)
+        colspacing = float(groups.get(44, 0.0))
+        rowspacing = float(groups.get(45, 0.0))
+        paths = self.block_paths(name, max(abs(sx), abs(sy)))
+        if not paths:
+            return
+        bx, by = self.blocks[name]['base']
+        ca = math.cos(angle)
+        sa = math.sin(angle)
+        for row in xrange(rows):
+            for col in xrange(cols):
+                # p' = insertion point + R*(S*(p - base) + array offset)
+                ox = col*colspacing - sx*bx
+                oy = row*rowspacing - sy*by
+                mat = [ca*sx, sa*sx, -sa*sy, ca*sy, x + ca*ox - sa*oy, y + sa*ox + ca*oy]
+                for path in paths:
+                    path = array('d', path)
+                    matrixApply(mat, path)
+                    self.paths.append(path)
+
+    def block_paths(self, name, scale):
+        """Paths of a block in block coordinates, flattened once.
+
+        Blocks get flattened for scale rounded up to a power of two,
+        so inserts scaled up still stay within tolerance.
+        """
+        bucket = 1.0
+        while bucket < scale*self.scale and bucket < 1e6:
+            bucket *= 2
+        key = (name, bucket)
+        paths = self.block_cache.get(key)
+        if paths is not None:
+            return paths
+        if name in self.expanding:
+            print "Block '%s' inserts itself, ignoring." % name
+            return []
+        state = (self.paths, self.tolerance, self.scale, self.linecount, self.polyline)
+        self.expanding.add(name)
+        self.paths = []
+        self.tolerance = self.tolerance*self.scale/bucket
+        self.scale = bucket
+        self.polyline = None
+        try:
+            for entity, pairs, line in self.blocks[name]['groups']:
+                self.linecount = line
+                self.dispatch(entity, pairs)
+            paths = self.paths
+        finally:
+            self.expanding.discard(name)
+            self.paths, self.tolerance, self.scale, self.linecount, self.polyline = state
+        self.block_cache[key] = paths
+        return paths
+
+    def polyline_path(self, vertices, closed):
+        """Path through (x, y, bulge) vertices, bulges flattened to arcs."""
+        path = array('d')
+        if not vertices:
+            return path
+        if closed:
+            vertices = list(vertices) + [vertices[0]]
+        x1, y1, bulge = vertices[0]
+        path.extend((x1, y1))
+        for x2, y2, nextbulge in vertices[1:]:
+            if bulge and (x1 != x2 or y1 != y2):
+                # bulge = tan(angle/4), negative for clockwise arcs
+                chord = math.hypot(x2-x1, y2-y1)
+                r = chord*(1+bulge*bulge)/(4*abs(bulge))
+                del path[-2:]  # arc adds it back
+                flatten.arc(path, x1, y1, r, r, 0, int(abs(bulge) > 1), int(bulge > 0),
+                            x2, y2, self.tolerance)
+            else:
+                path.extend((x2, y2))
+            x1, y1, bulge = x2, y2, nextbulge
+        if self.metricflag == 0:
+            path = array('d', [v*25.4 for v in path])
+        return path
 
+    def complain_invalid(self, name):
+        print "Invalid element '" + name + "' on line", self.linecount
+        print "Can't process this DXF file. Sorry!"
+        raise DXFError
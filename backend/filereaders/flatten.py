@@ -0,0 +1,240 @@
+"""
+Flattening of curves to polylines.
+
+Shared by the SVG and DXF readers. All functions append vertices to
+a packed path [x0,y0,x1,y1,...] and take the tolerance as the max
+distance allowed between the curve and the resulting polyline.
+
+Instead of recursive subdivision the number of segments is computed
+upfront, with Wang's formula for beziers and from the sagitta of a
+circular segment for arcs. The curve then gets evaluated at even
+parameter steps. B-splines start from such an estimate per knot span
+and double it where the result is not yet within tolerance.
+"""
+
+import math
+
+
+MAX_SEGMENTS = 65536  # protect from degenerate cases
+
+
+
+def segment_count(dd, tolerance):
+    """Segments for a curve with second derivative bound dd."""
+    if tolerance <= 0.0:
+        return MAX_SEGMENTS
+    n = int(math.ceil(math.sqrt(dd/tolerance)))
+    return min(max(n, 1), MAX_SEGMENTS)
+
+
+def cubic(path, x1, y1, x2, y2, x3, y3, x4, y4, tolerance):
+    """Append the inner vertices of a cubic bezier."""
+    # Wang's formula, n = sqrt(3*(3-1)/8 * max|P[i]-2P[i+1]+P[i+2]| / tolerance)
+    ddx = x1 - 2*x2 + x3
+    ddy = y1 - 2*y2 + y3
+    dd = ddx*ddx + ddy*ddy
+    ddx = x2 - 2*x3 + x4
+    ddy = y2 - 2*y3 + y4
+    dd = math.sqrt(max(dd, ddx*ddx + ddy*ddy))
+    n = segment_count(0.75*dd, tolerance)
+    if n < 2:
+        return
+    # polynomial coefficients
+    cx = 3.0*(x2 - x1)
+    bx = 3.0*(x3 - x2) - cx
+    ax = x4 - x1 - cx - bx
+    cy = 3.0*(y2 - y1)
+    by = 3.0*(y3 - y2) - cy
+    ay = y4 - y1 - cy - by
+    dt = 1.0/n
+    append = path.append
+    for i in xrange(1, n):
+        t = i*dt
+        append(((ax*t + bx)*t + cx)*t + x1)
+        append(((ay*t + by)*t + cy)*t + y1)
+
+
+def quadratic(path, x1, y1, x2, y2, x3, y3, tolerance):
+    """Append the inner vertices of a quadratic bezier."""
+    # Wang's formula, n = sqrt(2*(2-1)/8 * |P0-2P1+P2| / tolerance)
+    ddx = x1 - 2*x2 + x3
+    ddy = y1 - 2*y2 + y3
+    n = segment_count(0.25*math.sqrt(ddx*ddx + ddy*ddy), tolerance)
+    if n < 2:
+        return
+    bx = 2.0*(x2 - x1)
+    ax = x3 - x1 - bx
+    by = 2.0*(y2 - y1)
+    ay = y3 - y1 - by
+    dt = 1.0/n
+    append = path.append
+    for i in xrange(1, n):
+        t = i*dt
+        append((ax*t + bx)*t + x1)
+        append((ay*t + by)*t + y1)
+
+
+def arc_segment_count(r, angle, tolerance):
+    """Segments for a circular arc of radius r and angle (radians)."""
+    if tolerance >= r:
+        return 1
+    # sagitta of each segment stays within tolerance
+    step = 2.0*math.acos(1.0 - tolerance/r)
+    n = int(math.ceil(abs(angle)/step))
+    return min(max(n, 1), MAX_SEGMENTS)
+
+
+def arc(path, x1, y1, rx, ry, phi, large_arc, sweep, x2, y2, tolerance):
+    """Append an elliptical arc, including both of its end points.
+
+    Parameters are as in svg path data (endpoint parameterization),
+    phi is the x-axis rotation in radians.
+    """
+    # http://www.w3.org/TR/SVG/implnote.html#ArcImplementationNotes
+    if x1 == x2 and y1 == y2:
+        return
+    rx = abs(rx)
+    ry = abs(ry)
+    if rx == 0.0 or ry == 0.0:
+        # treated as a straight line
+        path.extend((x1, y1, x2, y2))
+        return
+    cp = math.cos(phi)
+    sp = math.sin(phi)
+    dx = 0.5 * (x1 - x2)
+    dy = 0.5 * (y1 - y2)
+    x_ = cp * dx + sp * dy
+    y_ = -sp * dx + cp * dy
+    # scale up radii too small to reach the end point
+    lam = (x_/rx)**2 + (y_/ry)**2
+    if lam > 1.0:
+        lam = math.sqrt(lam)
+        rx *= lam
+        ry *= lam
+    r2 = ((rx*ry)**2-(rx*y_)**2-(ry*x_)**2) / ((rx*y_)**2+(ry*x_)**2)
+    if r2 < 0:
+        r2 = 0
+    r = math.sqrt(r2)
+    if large_arc == sweep:
+        r = -r
+    cx_ = r*rx*y_ / ry
+    cy_ = -r*ry*x_ / rx
+    cx = cp*cx_ - sp*cy_ + 0.5*(x1 + x2)
+    cy = sp*cx_ + cp*cy_ + 0.5*(y1 + y2)
+
+    def _angle(ux, uy, vx, vy):
+        c = (ux*vx + uy*vy) / math.sqrt((ux*ux + uy*uy) * (vx*vx + vy*vy))
+        a = math.acos(min(1.0, max(-1.0, c)))
+        if ux*vy > uy*vx:
+            return a
+        return -a
+
+    psi = _angle(1.0, 0.0, (x_-cx_)/rx, (y_-cy_)/ry)
+    delta = _angle((x_-cx_)/rx, (y_-cy_)/ry, (-x_-cx_)/rx, (-y_-cy_)/ry)
+    if sweep and delta < 0:
+        delta += math.pi * 2
+    if not sweep and delta > 0:
+        delta -= math.pi * 2
+
+    n = arc_segment_count(max(rx, ry), delta, tolerance)
+    dt = delta/n
+    append = path.append
+    append(x1)
+    append(y1)
+    for i in xrange(1, n):
+        theta = psi + i*dt
+        ct = math.cos(theta)
+        st = math.sin(theta)
+        append(cp*rx*ct - sp*ry*st + cx)
+        append(sp*rx*ct + cp*ry*st + cy)
+    append(x2)
+    append(y2)
+
+
+def spline(path, degree, knots, points, weights, tolerance):
+    """Append a B-spline, including both of its end points.
+
+    points are the packed control points, knots the full knot vector
+    (len(points)/2 + degree + 1 values) and weights None or one per
+    control point (NURBS). Each knot span gets evaluated at even
+    parameter steps, starting with Wang's formula applied to the
+    span's control points and doubling the count until all chord
+    midpoints are within tolerance of the curve.
+    """
+    n = len(points)/2
+    if degree < 1 or n <= degree or len(knots) != n + degree + 1:
+        raise ValueError("invalid spline")
+    if weights is None:
+        weights = [1.0]*n
+    elif len(weights) != n:
+        raise ValueError("invalid spline weights")
+    # homogeneous coordinates
+    hx = [points[2*i]*weights[i] for i in xrange(n)]
+    hy = [points[2*i+1]*weights[i] for i in xrange(n)]
+    hw = list(weights)
+
+    def _point(k, t):
+        # de Boor's algorithm on knot span k
+        dx = hx[k-degree:k+1]
+        dy = hy[k-degree:k+1]
+        dw = hw[k-degree:k+1]
+        for r in xrange(1, degree+1):
+            for j in xrange(degree, r-1, -1):
+                i = j + k - degree
+                span = knots[i+degree-r+1] - knots[i]
+                if span:
+                    a = (t - knots[i]) / span
+                else:
+                    a = 0.0
+                b = 1.0 - a
+                dx[j] = b*dx[j-1] + a*dx[j]
+                dy[j] = b*dy[j-1] + a*dy[j]
+                dw[j] = b*dw[j-1] + a*dw[j]
+        return dx[degree]/dw[degree], dy[degree]/dw[degree]
+
+    tolerance2 = tolerance*tolerance
+    append = path.append
+    first = True
+    for k in xrange(degree, n):
+        t0 = float(knots[k])
+        t1 = float(knots[k+1])
+        if t1 <= t0:
+            continue
+        dd = 0.0
+        for i in xrange(k-degree, k-1):
+            ddx = points[2*i] - 2*points[2*i+2] + points[2*i+4]
+            ddy = points[2*i+1] - 2*points[2*i+3] + points[2*i+5]
+            dd = max(dd, ddx*ddx + ddy*ddy)
+        count = segment_count(degree*(degree-1)/8.0 * math.sqrt(dd), tolerance)
+        while 1:
+            dt = (t1 - t0)/count
+            vertices = [_point(k, t0 + i*dt) for i in xrange(count)]
+            vertices.append(_point(k, t1))
+            if count >= MAX_SEGMENTS or tolerance <= 0.0:
+                break
+            # check the deviation in the middle of each chord
+            for i in xrange(count):
+                x1, y1 = vertices[i]
+                x2, y2 = vertices[i+1]
+                mx, my = _point(k, t0 + (i + 0.5)*dt)
+                cx = x2 - x1
+                cy = y2 - y1
+                c2 = cx*cx + cy*cy
+                dx = mx - x1
+                dy = my - y1
+                if c2 > 0.0:
+                    cross = cx*dy - cy*dx
+                    d2 = cross*cross/c2
+                else:
+                    d2 = dx*dx + dy*dy
+                if d2 > tolerance2:
+                    count = min(2*count, MAX_SEGMENTS)
+                    break
+            else:
+                break
+        if not first:
+            vertices = vertices[1:]
+        first = False
+        for x, y in vertices:
+            append(x)
+            append(y)
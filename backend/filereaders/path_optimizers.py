@@ -1,8 +1,8 @@
 """
 Optimizations of polylines (path) and sets of polylines (paths).
 
-The format of a path is:
-[[x1,y1],[x2,y2],...]
+The format of a path is a packed array('d'):
+[x1,y1,x2,y2,...]
 
 The format of paths is:
 [path1, path2, ...] 
@@ -16,31 +16,135 @@ __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 
 
 import math
+import collections
+import heapq
 import logging
+import multiprocessing
+from array import array
+
+from .utilities import reversePath
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 log = logging.getLogger("svg_reader")
 
+NUMPY_MIN_SPAN = 64  # below this numpy overhead outweighs the gain
+PARALLEL_MIN_VERTICES = 20000  # per color, smaller ones are not worth a worker
+
 
 def join_segments(paths, epsilon2):
     """
     Join paths with congruent end/start points.
 
     This is Useful to optimize pseudo-polylines made from line segments.
+    Paths are chained in both directions regardless of their order
+    in the list, reversing them where needed. Endpoints are looked
+    up in a hash grid with cells the size of epsilon so this stays
+    about linear. A chain stops growing once it is a closed loop.
     """
     join_count = 0
+    size = math.sqrt(epsilon2) or 1.0
+    # endpoint ids: start of paths[i] is 2*i and its end 2*i+1
+    cells = {}
+    for i in xrange(len(paths)):
+        path = paths[i]
+        if path:
+            for pid, p in ((2*i, (path[0], path[1])), (2*i+1, (path[-2], path[-1]))):
+                key = (int(math.floor(p[0]/size)), int(math.floor(p[1]/size)))
+                if key in cells:
+                    cells[key].append(pid)
+                else:
+                    cells[key] = [pid]
+    used = [False]*len(paths)
+    # Cells hold ids in ascending order. Ids in front of a cell's
+    # start are all used, used ids further in get compacted away
+    # once they make up half of the rest. Otherwise lots of
+    # coincident endpoints would make each lookup linear.
+    starts = {}
+
+    def find(p):
+        # lowest unused endpoint id within epsilon of p, or None
+        cx = int(math.floor(p[0]/size))
+        cy = int(math.floor(p[1]/size))
+        found = None
+        for ix in (cx-1, cx, cx+1):
+            for iy in (cy-1, cy, cy+1):
+                key = (ix, iy)
+                cell = cells.get(key)
+                if cell is None:
+                    continue
+                j = starts.get(key, 0)
+                n = len(cell)
+                while j < n and used[cell[j] >> 1]:
+                    j += 1
+                dead = 0
+                for k in xrange(j, n):
+                    pid = cell[k]
+                    if found is not None and pid >= found:
+                        break
+                    if used[pid >> 1]:
+                        dead += 1
+                        continue
+                    path = paths[pid >> 1]
+                    e = -2 if pid & 1 else 0
+                    if (p[0]-path[e])**2 + (p[1]-path[e+1])**2 < epsilon2:
+                        found = pid
+                        break
+                if 2*dead > n - j:
+                    cell[:] = [pid for pid in cell[j:] if not used[pid >> 1]]
+                    j = 0
+                starts[key] = j
+        return found
+
+    def closed(first, last, count):
+        return count > 2 and (first[0]-last[0])**2 + (first[1]-last[1])**2 < epsilon2
+
     nPaths = []
-    for path in paths:
-		if nPaths:
-			lastpath = nPaths[-1:][0]
-			endpoint = lastpath[-1:][0]
-			d2 = (endpoint[0]-path[0][0])**2 + (endpoint[1]-path[0][1])**2
-			if d2 < epsilon2:
-				lastpath.extend(path[1:])
-				join_count += 1
-			else:
-				nPaths.append(path)
-		else:
-			nPaths.append(path)
+    for i in xrange(len(paths)):
+        if used[i]:
+            continue
+        chain = paths[i]
+        used[i] = True
+        if not chain:
+            nPaths.append(chain)
+            continue
+        # grow forward from the end
+        first = (chain[0], chain[1])
+        while not closed(first, (chain[-2], chain[-1]), len(chain)/2):
+            pid = find((chain[-2], chain[-1]))
+            if pid is None:
+                break
+            path = paths[pid >> 1]
+            used[pid >> 1] = True
+            if pid & 1:
+                reversePath(path)
+            chain.extend(path[2:])
+            join_count += 1
+        # grow backward from the start, pieces in reverse order
+        count = len(chain)/2
+        pieces = []
+        while not closed(first, (chain[-2], chain[-1]), count):
+            pid = find(first)
+            if pid is None:
+                break
+            path = paths[pid >> 1]
+            used[pid >> 1] = True
+            if not pid & 1:
+                reversePath(path)
+            pieces.append(path[:-2])
+            first = (path[0], path[1])
+            count += len(path)/2 - 1
+            join_count += 1
+        if pieces:
+            nchain = array('d')
+            for piece in reversed(pieces):
+                nchain.extend(piece)
+            nchain.extend(chain)
+            chain = nchain
+        nPaths.append(chain)
     # report pseudo-polyline joining operations
     if join_count > 100:
         log.info("joined many line segments: " + str(join_count))
@@ -53,7 +157,7 @@ def simplify(path, tolerance2):
     """
     Douglas-Peucker polyline simplification.
 
-    path ... [[x1,y1],[x2,y2],...] polyline
+    path ... [x1,y1,x2,y2,...] packed polyline
     tolerance2  ... approximation tolerance squared
     ===============================================
     Copyright 2002, softSurfer (www.softsurfer.com)
@@ -64,103 +168,144 @@ def simplify(path, tolerance2):
     Users of this code must verify correctness for their application.
     http://softsurfer.com/Archive/algorithm_0205/algorithm_0205.htm
     """
-    def sum(u,v): return [u[0]+v[0], u[1]+v[1]]
-    def diff(u,v): return [u[0]-v[0], u[1]-v[1]]
-    def prod(u,v): return [u[0]*v[0], u[1]*v[1]]
-    def dot(u,v): return u[0]*v[0] + u[1]*v[1]
-    def norm2(v): return v[0]*v[0] + v[1]*v[1]
-    def norm(v): return math.sqrt(norm2(v))
-    def d2(u,v): return norm2(diff(u,v))
-    def d(u,v): return norm(diff(u,v))
-    
-    def simplifyDP(tol2, v, j, k, mk):
-        #  This is the Douglas-Peucker recursive simplification routine
-        #  It just marks vertices that are part of the simplified polyline
-        #  for approximating the polyline subchain v[j] to v[k].
-        #  mk[] ... array of markers matching vertex array v[]
-        if k <= j+1:  # there is nothing to simplify
-            return
-        # check for adequate approximation by segment S from v[j] to v[k]
-        maxi = j           # index of vertex farthest from S
-        maxd2 = 0          # distance squared of farthest vertex
-        S = [v[j], v[k]]   # segment from v[j] to v[k]
-        u = diff(S[1], S[0])    # segment direction vector
-        cu = norm2(u)      # segment length squared
-        # test each vertex v[i] for max distance from S
-        # compute using the Feb 2001 Algorithm's dist_Point_to_Segment()
-        # Note: this works in any dimension (2D, 3D, ...)
-        w = None           # vector
-        Pb = None          # point, base of perpendicular from v[i] to S
-        b = None
-        cw = None
-        dv2 = None         # dv2 = distance v[i] to S squared
-        for i in xrange(j+1, k):
-            # compute distance squared
-            w = diff(v[i], S[0])
-            cw = dot(w,u)
-            if cw <= 0:
-                dv2 = d2(v[i], S[0])
-            elif cu <= cw:
-                dv2 = d2(v[i], S[1])
-            else:
-                b = cw / cu
-                Pb = [S[0][0]+b*u[0], S[0][1]+b*u[1]]
-                dv2 = d2(v[i], Pb)
-            # test with current max distance squared
-            if dv2 <= maxd2:
-                continue
-            # v[i] is a new max vertex
-            maxi = i
-            maxd2 = dv2
-        if maxd2 > tol2:       # error is worse than the tolerance
-            # split the polyline at the farthest vertex from S
-            mk[maxi] = 1       # mark v[maxi] for the simplified polyline
-            # recursively simplify the two subpolylines at v[maxi]
-            simplifyDP(tol2, v, j, maxi, mk)  # polyline v[j] to v[maxi]
-            simplifyDP(tol2, v, maxi, k, mk)  # polyline v[maxi] to v[k]
-        # else the approximation is OK, so ignore intermediate vertices
-        return
-    
-    n = len(path)
+    n = len(path)/2
     if n == 0:
-        return []
-    sPath = []
-    tPath = []                   # vertex buffer, points
+        return array('d')
 
     # STAGE 1.  Vertex Reduction within tolerance of prior vertex cluster
-    tPath.append(path[0])        # start at the beginning
-    k = 1
-    pv = 0
+    keep = [0]                   # indices of remaining vertices
+    px = path[0]
+    py = path[1]
     for i in xrange(1, n):
-        if d2(path[i], path[pv]) < tolerance2:
+        dx = path[2*i] - px
+        dy = path[2*i+1] - py
+        if dx*dx + dy*dy < tolerance2:
             continue
-        tPath.append(path[i])
-        k += 1
-        pv = i
-    if pv < n-1:
-        tPath.append(path[n-1])  # finish at the end
-        k += 1
+        keep.append(i)
+        px = path[2*i]
+        py = path[2*i+1]
+    if keep[-1] < n-1:
+        keep.append(n-1)         # finish at the end
 
     # STAGE 2.  Douglas-Peucker polyline simplification
-    mk = [None for i in xrange(k)]    # marker buffer, ints
-    mk[0] = mk[k-1] = 1;              # mark the first and last vertices
-    simplifyDP(tolerance2, tPath, 0, k-1, mk)
+    # This marks vertices that are part of the simplified polyline.
+    # Instead of recursing, spans v[j] to v[k] to be checked go on
+    # a stack. Marks do not depend on the order spans are done in.
+    k = len(keep)
+    xs = array('d', [path[2*i] for i in keep])
+    ys = array('d', [path[2*i+1] for i in keep])
+    nxs = nys = None
+    if numpy is not None and k > NUMPY_MIN_SPAN:
+        nxs = numpy.frombuffer(xs)
+        nys = numpy.frombuffer(ys)
+    mk = bytearray(k)            # marker buffer
+    mk[0] = mk[k-1] = 1          # mark the first and last vertices
+    stack = [(0, k-1)]
+    while stack:
+        j, k = stack.pop()
+        if k <= j+1:  # there is nothing to simplify
+            continue
+        if nxs is not None and k-j > NUMPY_MIN_SPAN:
+            maxi, maxd2 = _farthest_numpy(nxs, nys, j, k)
+        else:
+            maxi, maxd2 = _farthest(xs, ys, j, k)
+        if maxd2 > tolerance2:   # error is worse than the tolerance
+            # split the polyline at the farthest vertex from S
+            mk[maxi] = 1
+            stack.append((maxi, k))
+            stack.append((j, maxi))
+        # else the approximation is OK, so ignore intermediate vertices
 
     # copy marked vertices to the output simplified polyline
-    for i in xrange(k):
+    sPath = array('d')
+    for i in xrange(len(keep)):
         if mk[i]:
-            sPath.append(tPath[i])
+            sPath.append(xs[i])
+            sPath.append(ys[i])
     return sPath
 
 
+def _farthest(xs, ys, j, k):
+    """
+    Vertex between j and k farthest from segment S from v[j] to v[k].
+
+    Returns (index, distance squared), the first one on ties. Uses
+    the Feb 2001 Algorithm's dist_Point_to_Segment().
+    """
+    x0 = xs[j]
+    y0 = ys[j]
+    x1 = xs[k]
+    y1 = ys[k]
+    ux = x1 - x0       # segment direction vector
+    uy = y1 - y0
+    cu = ux*ux + uy*uy # segment length squared
+    maxi = j
+    maxd2 = 0
+    for i in xrange(j+1, k):
+        wx = xs[i] - x0
+        wy = ys[i] - y0
+        cw = wx*ux + wy*uy
+        if cw <= 0:
+            dv2 = wx*wx + wy*wy
+        elif cu <= cw:
+            dx = xs[i] - x1
+            dy = ys[i] - y1
+            dv2 = dx*dx + dy*dy
+        else:
+            # base of perpendicular from v[i] to S
+            b = cw / cu
+            dx = xs[i] - (x0 + b*ux)
+            dy = ys[i] - (y0 + b*uy)
+            dv2 = dx*dx + dy*dy
+        if dv2 > maxd2:
+            maxi = i
+            maxd2 = dv2
+    return maxi, maxd2
+
+
+def _farthest_numpy(xs, ys, j, k):
+    """Same as _farthest, vectorized over the span."""
+    x0 = xs[j]
+    y0 = ys[j]
+    x1 = xs[k]
+    y1 = ys[k]
+    ux = x1 - x0
+    uy = y1 - y0
+    cu = ux*ux + uy*uy
+    X = xs[j+1:k]
+    Y = ys[j+1:k]
+    wx = X - x0
+    wy = Y - y0
+    cw = wx*ux + wy*uy
+    # to start
+    dv2 = wx*wx + wy*wy
+    # to end
+    sel = (cw > 0) & (cu <= cw)
+    if sel.any():
+        dx = X[sel] - x1
+        dy = Y[sel] - y1
+        dv2[sel] = dx*dx + dy*dy
+    # to base of perpendicular
+    sel = (cw > 0) & (cu > cw)
+    if sel.any():
+        b = cw[sel] / cu
+        dx = X[sel] - (x0 + b*ux)
+        dy = Y[sel] - (y0 + b*uy)
+        dv2[sel] = dx*dx + dy*dy
+    i = int(dv2.argmax())
+    if dv2[i] > 0:
+        return j+1+i, float(dv2[i])
+    return j, 0
+
+
 
 def simplify_all(paths, tolerance2):
     totalverts = 0
     optiverts = 0
     for u in xrange(len(paths)):
-        totalverts += len(paths[u])
+        totalverts += len(paths[u])/2
         paths[u] = simplify(paths[u], tolerance2)
-        optiverts += len(paths[u])
+        optiverts += len(paths[u])/2
     # report polyline optimizations    
     difflength = totalverts - optiverts
     diffpct = (100*difflength/totalverts)
@@ -169,35 +314,506 @@ def simplify_all(paths, tolerance2):
 
 
 
-def sort_by_seektime(paths, start=[0.0, 0.0]):
-    # sort paths to optimize seek distances in between
-    endpoint = start
-    for i in xrange(len(paths)):
-        if i > 0:
-            endpoint = paths[i-1][len(paths[i-1])-1]
-        # search the rest of array for closest path start point
-        d2_hash = {}  # distance2:index pairs
-        for j in xrange(i,len(paths)):
-            startpoint = paths[j][0]
-            d2_hash[ (endpoint[0]-startpoint[0])**2 + (endpoint[1]-startpoint[1])**2 ] = j
-        d2min = 9999999999999999.9
-        d2minIndex = None
-        for d2 in d2_hash:
-            if d2 < d2min:
-                d2min = d2 
-                d2minIndex = d2_hash[d2]
-        # make closest subpath next item
-        if d2minIndex != i:
-            tempItem = paths[i]
-            paths[i] = paths[d2minIndex]
-            paths[d2minIndex] = tempItem
-
-
-
-def optimize_all(boundarys, tolerance):
-    tolerance2 = tolerance**2
-    epsilon2 = (0.1*tolerance)**2
-    for color in boundarys:
-        boundarys[color] = join_segments(boundarys[color], epsilon2)
-        simplify_all(boundarys[color], tolerance2)
-        sort_by_seektime(boundarys[color])
+class PointTree:
+    """
+    k-d tree over points for nearest neighbour queries.
+
+    Points are (x,y) tuples addressed by their index in points.
+    Coincident points share one site, a list of their indices.
+    The sites are split at the median along the wider side of
+    their bounds, so the tree adapts to how the points are spread
+    out and clustered input (a small engraving in a big frame, a
+    far outlier) costs no more than uniform input. Nodes keep the
+    bounds of their sites and how many sites are left below them,
+    queries skip subtrees that are too far or emptied. The tree
+    gets rebuilt as it thins out to keep the bounds tight.
+    """
+
+    LEAF_SIZE = 8
+
+    def __init__(self, points, ids=None):
+        self.points = points
+        if ids is None:
+            self.alive = [True]*len(points)
+        else:
+            self.alive = [False]*len(points)
+            for i in ids:
+                self.alive[i] = True
+        self.count = self.alive.count(True)
+        self._build()
+
+    def _build(self):
+        points = self.points
+        alive = self.alive
+        # indices by point, in descending order
+        # so the lowest remaining one is at the end
+        by_point = {}
+        for i in xrange(len(points)-1, -1, -1):
+            if alive[i]:
+                p = points[i]
+                if p in by_point:
+                    by_point[p].append(i)
+                else:
+                    by_point[p] = [i]
+        site_points = by_point.keys()
+        self.site_points = site_points
+        self.site_ids = [by_point[p] for p in site_points]
+        self.sites = dict((p, s) for s, p in enumerate(site_points))
+        self.built_count = self.count
+        # nodes, children are -1 for leafs
+        self.order = range(len(site_points))
+        self.lo = []
+        self.hi = []
+        self.left = []
+        self.right = []
+        self.parent = []
+        self.box = []
+        self.live = []
+        self.leaf = [0]*len(site_points)
+        if site_points:
+            self._build_node(0, len(site_points), -1)
+
+    def _build_node(self, lo, hi, parent):
+        site_points = self.site_points
+        order = self.order
+        node = len(self.lo)
+        xs = [site_points[s][0] for s in order[lo:hi]]
+        ys = [site_points[s][1] for s in order[lo:hi]]
+        box = (min(xs), min(ys), max(xs), max(ys))
+        self.lo.append(lo)
+        self.hi.append(hi)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.parent.append(parent)
+        self.box.append(box)
+        self.live.append(hi-lo)
+        if hi - lo <= self.LEAF_SIZE:
+            for s in order[lo:hi]:
+                self.leaf[s] = node
+        else:
+            axis = 0 if box[2]-box[0] >= box[3]-box[1] else 1
+            order[lo:hi] = sorted(order[lo:hi], key=lambda s: site_points[s][axis])
+            mid = (lo+hi)//2
+            self.left[node] = self._build_node(lo, mid, node)
+            self.right[node] = self._build_node(mid, hi, node)
+        return node
+
+    def remove(self, i):
+        if self.alive[i]:
+            self.alive[i] = False
+            self.count -= 1
+            s = self.sites[self.points[i]]
+            ids = self.site_ids[s]
+            while ids and not self.alive[ids[-1]]:
+                ids.pop()
+            if not ids:
+                node = self.leaf[s]
+                while node != -1:
+                    self.live[node] -= 1
+                    node = self.parent[node]
+            if self.count and self.count < self.built_count/4:
+                self._build()
+
+    def _children(self, node, x, y):
+        """Live children of node with their distance (squared) from
+        x,y, the closer one last."""
+        children = []
+        for c in (self.left[node], self.right[node]):
+            if self.live[c]:
+                x0, y0, x1, y1 = self.box[c]
+                dx = x0-x if x < x0 else x-x1 if x > x1 else 0.0
+                dy = y0-y if y < y0 else y-y1 if y > y1 else 0.0
+                children.append((dx*dx + dy*dy, c))
+        if len(children) == 2 and children[0][0] < children[1][0]:
+            children.reverse()
+        return children
+
+    def nearest(self, x, y):
+        """Index of the closest remaining point, None if empty."""
+        if not self.count:
+            return None
+        site_points = self.site_points
+        site_ids = self.site_ids
+        order = self.order
+        left = self.left
+        best = None
+        bestd2 = 0.0
+        stack = [(0.0, 0)]
+        while stack:
+            d2, node = stack.pop()
+            if best is not None and d2 > bestd2:
+                continue
+            if left[node] == -1:
+                for s in order[self.lo[node]:self.hi[node]]:
+                    ids = site_ids[s]
+                    if ids:
+                        i = ids[-1]  # lowest remaining here
+                        p = site_points[s]
+                        d2 = (p[0]-x)**2 + (p[1]-y)**2
+                        if best is None or d2 < bestd2 or (d2 == bestd2 and i < best):
+                            best = i
+                            bestd2 = d2
+            else:
+                stack.extend(self._children(node, x, y))
+        return best
+
+    def k_nearest(self, x, y, k):
+        """Indices of up to k closest remaining points, closest first."""
+        if not self.count or k < 1:
+            return []
+        site_points = self.site_points
+        site_ids = self.site_ids
+        alive = self.alive
+        order = self.order
+        left = self.left
+        # max-heap of the k closest so far, worst on top
+        found = []
+        stack = [(0.0, 0)]
+        while stack:
+            d2, node = stack.pop()
+            if len(found) == k and d2 > -found[0][0]:
+                continue
+            if left[node] == -1:
+                for s in order[self.lo[node]:self.hi[node]]:
+                    ids = site_ids[s]
+                    if not ids:
+                        continue
+                    p = site_points[s]
+                    d2 = (p[0]-x)**2 + (p[1]-y)**2
+                    # the k lowest of a site are all it can add
+                    taken = 0
+                    for i in reversed(ids):
+                        if alive[i]:
+                            if len(found) < k:
+                                heapq.heappush(found, (-d2, -i))
+                            elif (d2, i) < (-found[0][0], -found[0][1]):
+                                heapq.heapreplace(found, (-d2, -i))
+                            else:
+                                break
+                            taken += 1
+                            if taken == k:
+                                break
+            else:
+                stack.extend(self._children(node, x, y))
+        found.sort(reverse=True)
+        return [-i for d2, i in found]
+
+
+
+def sort_by_seektime(paths, start=[0.0, 0.0], reverse=True):
+    """
+    Order paths to minimize seek distances in between.
+
+    Greedy nearest neighbour: from the current position always go
+    to the closest path start (or path end if reverse is True, in
+    which case the path gets reversed). A PointTree keeps this at
+    about O(n log n) for typical drawings.
+    """
+    n = len(paths)
+    # endpoints by id, start of paths[i] is 2*i and its end 2*i+1
+    points = [None]*(2*n)
+    ids = []
+    for i in xrange(n):
+        path = paths[i]
+        if path:
+            points[2*i] = (path[0], path[1])
+            points[2*i+1] = (path[-2], path[-1])
+            ids.append(2*i)
+            if reverse and points[2*i] != points[2*i+1]:
+                ids.append(2*i+1)
+    tree = PointTree(points, ids)
+    order = []
+    x = start[0]
+    y = start[1]
+    while tree.count:
+        pid = tree.nearest(x, y)
+        i = pid >> 1
+        tree.remove(2*i)
+        tree.remove(2*i+1)
+        path = paths[i]
+        if pid & 1:
+            reversePath(path)
+        order.append(path)
+        x = path[-2]
+        y = path[-1]
+    # empty paths go last
+    for path in paths:
+        if not path:
+            order.append(path)
+    paths[:] = order
+
+
+
+def seek_distance(paths, start=[0.0, 0.0]):
+    """Total travel of the seek moves from start through all paths."""
+    total = 0.0
+    x = start[0]
+    y = start[1]
+    for path in paths:
+        if path:
+            total += math.hypot(path[0]-x, path[1]-y)
+            x = path[-2]
+            y = path[-1]
+    return total
+
+
+def improve_seektime(paths, start=[0.0, 0.0], max_steps=None, neighbors=8):
+    """
+    Shorten seek moves of an already ordered path list.
+
+    Applies 2-opt (reverse a run of paths) and Or-opt (move a run
+    of one to three paths elsewhere, optionally reversed) until no
+    move helps or after max_steps steps of the work queue. Bounding
+    steps rather than time keeps the result the same on any machine.
+    Candidate moves only consider the nearest few endpoints of each
+    path end. Paths may get reversed. Works in-place.
+    """
+    paths[:] = [path for path in paths if path] + [path for path in paths if not path]
+    n = len([path for path in paths if path])
+    if n < 2:
+        return
+    # Endpoints by id: the origin is 0 and 1, start of paths[i]
+    # is 2*(i+1) and its end 2*(i+1)+1. Node 0 is the origin and
+    # always stays in front.
+    ex = [start[0], start[0]]
+    ey = [start[1], start[1]]
+    for i in xrange(n):
+        path = paths[i]
+        ex.append(path[0]); ey.append(path[1])
+        ex.append(path[-2]); ey.append(path[-1])
+    tree = PointTree(zip(ex, ey), xrange(2, 2*n+2))
+    near = [[]]*2
+    for q in xrange(2, 2*n+2):
+        near.append(tree.k_nearest(ex[q], ey[q], neighbors+1))
+    tour = range(n+1)
+    pos = range(n+1)
+    flip = [False]*(n+1)
+    hypot = math.hypot
+
+    def S(node):
+        return 2*node + flip[node]
+
+    def E(node):
+        return 2*node + 1 - flip[node]
+
+    def d(p, q):
+        return hypot(ex[p]-ex[q], ey[p]-ey[q])
+
+    def gap(a):
+        # seek move leaving tour position a
+        if a >= n:
+            return 0.0
+        return d(E(tour[a]), S(tour[a+1]))
+
+    def two_opt_delta(a, b):
+        # reverse tour[a+1..b]
+        delta = d(E(tour[a]), E(tour[b])) - gap(a) - gap(b)
+        if b < n:
+            delta += d(S(tour[a+1]), S(tour[b+1]))
+        return delta
+
+    def two_opt(a, b):
+        seg = tour[a+1:b+1]
+        seg.reverse()
+        tour[a+1:b+1] = seg
+        for k in xrange(a+1, b+1):
+            node = tour[k]
+            pos[node] = k
+            flip[node] = not flip[node]
+
+    def or_opt_delta(i, length, j, rev):
+        # move tour[i..i+length-1] behind tour[j], reversed if rev
+        first = tour[i]
+        last = tour[i+length-1]
+        delta = -gap(i-1) - gap(i+length-1) - gap(j)
+        if i+length <= n:
+            delta += d(E(tour[i-1]), S(tour[i+length]))
+        if rev:
+            head = E(last)
+            tail = S(first)
+        else:
+            head = S(first)
+            tail = E(last)
+        delta += d(E(tour[j]), head)
+        if j < n:
+            delta += d(tail, S(tour[j+1]))
+        return delta
+
+    def or_opt(i, length, j, rev):
+        seg = tour[i:i+length]
+        if rev:
+            seg.reverse()
+            for node in seg:
+                flip[node] = not flip[node]
+        if j < i:
+            tour[j+1:i+length] = seg + tour[j+1:i]
+            lo, hi = j+1, i+length
+        else:
+            tour[i:j+1] = tour[i+length:j+1] + seg
+            lo, hi = i, j+1
+        for k in xrange(lo, hi):
+            pos[tour[k]] = k
+
+    # work queue of nodes whose seek moves may be improvable,
+    # a node gets queued again when a move touches its neighbours
+    queue = collections.deque(xrange(1, n+1))
+    queued = [True]*(n+1)
+
+    def touch(positions):
+        for k in positions:
+            if 1 <= k <= n and not queued[tour[k]]:
+                queued[tour[k]] = True
+                queue.append(tour[k])
+
+    steps = max_steps
+    while queue:
+        if steps is not None:
+            if steps <= 0:
+                break
+            steps -= 1
+        node = queue.popleft()
+        queued[node] = False
+        # 2-opt, new seek move joining ends or starts of two paths
+        a = pos[node]
+        best = -1e-9
+        move = None
+        for q in near[E(node)]:
+            other = q >> 1
+            if q != E(other) or other == node:
+                continue
+            b = pos[other]
+            x, y = min(a, b), max(a, b)
+            delta = two_opt_delta(x, y)
+            if delta < best:
+                best = delta
+                move = (x, y)
+        for q in near[S(node)]:
+            other = q >> 1
+            if q != S(other) or other == node:
+                continue
+            b = pos[other]
+            x, y = min(a, b)-1, max(a, b)-1
+            delta = two_opt_delta(x, y)
+            if delta < best:
+                best = delta
+                move = (x, y)
+        if move:
+            x, y = move
+            two_opt(x, y)
+            touch((x, x+1, y, y+1))
+            continue
+        # or-opt, runs starting at this node moved near their ends
+        i = pos[node]
+        for length in (1, 2, 3):
+            if i+length-1 > n:
+                break
+            targets = set()
+            for q in near[S(tour[i])] + near[E(tour[i+length-1])]:
+                k = pos[q >> 1]
+                targets.add(k)
+                targets.add(k-1)
+            for j in targets:
+                if j < 0 or i-1 <= j <= i+length-1:
+                    continue
+                for rev in (False, True):
+                    delta = or_opt_delta(i, length, j, rev)
+                    if delta < best:
+                        best = delta
+                        move = (i, length, j, rev)
+        if move:
+            i, length, j, rev = move
+            nodes = [tour[k] for k in (i-1, i, i+length-1, i+length, j, j+1) if k <= n]
+            or_opt(i, length, j, rev)
+            touch([pos[m] for m in nodes])
+    _apply_tour(paths, tour, flip)
+
+
+def _apply_tour(paths, tour, flip):
+    ordered = paths[:]
+    for k in xrange(1, len(tour)):
+        path = ordered[tour[k]-1]
+        if flip[tour[k]]:
+            reversePath(path)
+        paths[k-1] = path
+
+
+
+def optimize_paths(paths, tolerance, improve_steps=0):
+    """
+    Join, simplify and order the paths of one color.
+
+    Returns the new paths and the seek distance before and after
+    improve_seektime (None if improve_steps is 0).
+    """
+    paths = join_segments(paths, (0.1*tolerance)**2)
+    simplify_all(paths, tolerance**2)
+    sort_by_seektime(paths)
+    seek = None
+    if improve_steps > 0:
+        before = seek_distance(paths)
+        improve_seektime(paths, max_steps=improve_steps)
+        seek = (before, seek_distance(paths))
+    return paths, seek
+
+
+def _optimize_paths_star(args):
+    # Pool.map passes one argument
+    return optimize_paths(*args)
+
+
+def make_pool(processes=None):
+    """
+    Worker pool for optimize_all, None if it would not pay off.
+
+    processes is the number of workers, None for one per cpu.
+    Workers get forked, so make the pool at startup before any
+    other threads run or devices are open, and reuse it.
+    """
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    if processes < 2:
+        return None
+    try:
+        return multiprocessing.Pool(processes)
+    except (OSError, ImportError), e:
+        # e.g. no working sem_open on this platform
+        log.warn("process pool unavailable, optimizing serially: %s" % e)
+        return None
+
+
+def optimize_all(boundarys, tolerance, improve_steps=0, pool=None):
+    """
+    Join, simplify and order the paths of every color.
+
+    With improve_steps > 0 the greedy path order gets refined by
+    improve_seektime. The steps are split over the colors by their
+    path counts.
+
+    Colors are independent and with a pool (see make_pool) colors
+    get optimized by its workers when there are at least two big
+    ones. Since the refining is bounded by steps, not time, results
+    are the same with or without a pool.
+    """
+    colors = sorted(boundarys)
+    total = sum(len(paths) for paths in boundarys.itervalues())
+    jobs = []
+    for color in colors:
+        steps = 0
+        if improve_steps > 0:
+            steps = max(improve_steps*len(boundarys[color])/total, 1)
+        jobs.append((boundarys[color], tolerance, steps))
+    big = 0
+    for paths in boundarys.itervalues():
+        if sum(len(path) for path in paths) >= 2*PARALLEL_MIN_VERTICES:
+            big += 1
+    if pool is not None and big >= 2:
+        results = pool.map(_optimize_paths_star, jobs, 1)
+    else:
+        results = [optimize_paths(*job) for job in jobs]
+    for color, (paths, seek) in zip(colors, results):
+        boundarys[color] = paths
+        if seek:
+            log.info("seek distance of %s cut from %.1f to %.1f" % (color, seek[0], seek[1]))
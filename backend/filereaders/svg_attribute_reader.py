@@ -6,7 +6,7 @@ import math
 import logging
 
 from .webcolors import rgb_to_hex, normalize_hex, css3_names_to_hex
-from .utilities import matrixMult, parseFloats
+from .utilities import matrixMult, parseFloats, parsePathData
 
 log = logging.getLogger("svg_reader")
 
@@ -176,14 +176,7 @@ class SVGAttributeReader:
     def dAttrib(self, node, attr, value):
         """Read the 'd' attribute, complex path data."""
         # http://www.w3.org/TR/SVG11/paths.html
-        d = re.findall('([A-Za-z]|-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)', value)  # letters or float
-        # convert num strings to actual nums
-        for i in range(len(d)):
-            try:
-                d[i] = float(d[i])
-            except ValueError:
-                pass  # ok too, probably a command letter
-        node[attr] = d
+        node[attr] = parsePathData(value)
 
 
     def pointsAttrib(self, node, attr, value):
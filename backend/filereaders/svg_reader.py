@@ -4,16 +4,29 @@ __author__ = 'Stefan Hechenberger <stefan@nortd.com>'
 import re
 import math
 import logging
+import StringIO
+from array import array
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
 from .webcolors import hex_to_rgb, rgb_to_hex
-from .utilities import matrixMult, matrixApply, vertexScale, parseFloats
+from .utilities import matrixMult, matrixApply, parseFloats
 from .svg_tag_reader import SVGTagReader
 
 
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+REF_MAX_SUBTREE = 1024*1024  # bytes, bigger ones can not be referenced by 'use'
+REF_MAX_BYTES = 8*1024*1024  # kept for 'use' tags in total
+REF_ELEMENT_BYTES = 500  # rough overhead of a parsed element
+# tags that draw nothing when referenced, never kept for 'use'
+UNREF_TAGS = ('image', 'text')
+
+# inherited by referenced content, part of the instance cache key
+INHERITED_STYLE = ('display', 'visibility', 'fill', 'stroke', 'color',
+                   'fill-opacity', 'stroke-opacity', 'opacity')
+
 logging.basicConfig()
 log = logging.getLogger("svg_reader")
 # log.setLevel(logging.DEBUG)
@@ -42,6 +55,7 @@ log.setLevel(logging.INFO)
 #   * non-pixel units (cm, mm, in, pt, pc)
 #   * 'style' attribute and presentation attributes
 #   * curves, arcs, cirles, ellipses tesellated according to tolerance
+#   * defs, symbol and use, referenced content is tessellated once
 #  
 # Intentinally not Supported:
 #   * markers
@@ -68,8 +82,8 @@ class SVGReader:
         self._tagReader = SVGTagReader(tolerance)
 
         # parsed path data, paths by color
-        # {'#ff0000': [[[x,y], [x,y], ...], [], ..], '#0000ff':[]}
-        # Each path is a list of vertices which is a list of two floats.        
+        # {'#ff0000': [[x,y,x,y,...], [], ..], '#0000ff':[]}
+        # Each path is a packed array('d') of vertex coordinates.
         self.boundarys = {}
 
         # the px unit DPIs, conversion to real-world dimensions
@@ -92,8 +106,19 @@ class SVGReader:
         # value is the actual value to use
         self.lasertags = []
         
-        # # tags that should not be further traversed
-        # self.ignore_tags = {'defs':None, 'pattern':None, 'clipPath':None}
+        # tags that should not be further traversed,
+        # their subtrees get dropped while parsing
+        self.skip_tags = set(['image', 'defs', 'symbol'])
+
+        # elements with an id attribute, kept for 'use' tags
+        self.refs = {}
+        self.ref_bytes = 0  # see _elementBytes
+        # 'use' tags referencing not yet parsed elements, [(id, node), ..]
+        self.pending_uses = []
+        # tessellated referenced content as [(color, path), ..]
+        # by (id, scale bucket, inherited style)
+        self.ref_cache = {}
+        self.expanding = set()  # ids being instanced, against cycles
 
 
         
@@ -102,10 +127,13 @@ class SVGReader:
 
         This traverses through the document tree and collects all path
         data and converts it to polylines of the requested tolerance.
+        svgstring may also be a file object. The document is parsed
+        incrementally so memory depends on tree depth, not file size.
 
         Path data is returned as paths by color:
         {'#ff0000': [[path0, path1, ..], [path0, ..], ..]}
-        Each path is a list of vertices which is a list of two floats.
+        Each path is a packed array('d') of vertex coordinates
+        [x0,y0,x1,y1,...].
         
         One issue with svg documents is that they use px (or unit-less)
         dimensions and most vector apps are not explicit how to convert
@@ -120,15 +148,114 @@ class SVGReader:
         """        
         self.dpi = None
         self.boundarys = {}
+        self.refs = {}
+        self.ref_bytes = 0
+        self.pending_uses = []
+        self.ref_cache = {}
+
+        # parse xml incrementally, elements are dropped once done
+        if hasattr(svgstring, 'read'):
+            source = HeadRecorder(svgstring, 400)
+        else:
+            source = HeadRecorder(StringIO.StringIO(svgstring), 400)
+        # open elements as [element, node, size, attached, keep] lists,
+        # node is None for elements that are not traversed, size counts
+        # the kept bytes (see _elementBytes) of the subtree of elements
+        # with an id (None when too big), attached counts children left
+        # in the tree for an id ancestor and keep tells whether the
+        # element is drawn when referenced, only those are kept
+        stack = []
+        textDepth = None  # keep text tags until their end
+        openRefs = 0  # open elements with an id, their subtrees are kept
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                tagName = self._tagReader._get_tag(elem)
+                if not stack:
+                    if tagName != 'svg':
+                        log.error("Invalid file, no 'svg' tag found.")
+                        return self.boundarys
+                    stack.append([elem, self.parse_root(elem, source.head, force_dpi), None, 0, True])
+                    continue
+                keep = stack[-1][4] and tagName not in UNREF_TAGS \
+                    and self._tagReader.has_handler(elem)
+                size = None
+                if keep and 'id' in elem.attrib and self.ref_bytes < REF_MAX_BYTES:
+                    size = 0
+                    openRefs += 1
+                node = None
+                parentNode = stack[-1][1]
+                if parentNode is not None and self._tagReader.has_handler(elem):
+                    node = self.new_node(parentNode)
+                    if tagName == 'text':
+                        # needs its content, read at the end
+                        if textDepth is None:
+                            textDepth = len(stack)
+                        else:
+                            node = None
+                    elif tagName == 'use':
+                        self.read_use(elem, node)
+                        node = None
+                    else:
+                        self.read_tag(elem, node)
+                        if tagName in self.skip_tags:
+                            node = None
+                stack.append([elem, node, size, 0, keep])
+            else:
+                elem, node, size, attached, keep = stack.pop()
+                if textDepth == len(stack):
+                    self.read_tag(elem, node)
+                    textDepth = None
+                kept = False
+                if size is not None:
+                    openRefs -= 1
+                    size += _elementBytes(elem)
+                    if size <= REF_MAX_SUBTREE and self.ref_bytes + size <= REF_MAX_BYTES:
+                        self.refs[elem.get('id')] = elem
+                        self.ref_bytes += size
+                        kept = True
+                if textDepth is not None:
+                    continue
+                if openRefs and keep:
+                    # part of a subtree that may be referenced
+                    cost = _elementBytes(elem)
+                    for entry in stack:
+                        if entry[2] is not None:
+                            entry[2] += cost
+                            if entry[2] > REF_MAX_SUBTREE:
+                                entry[2] = None
+                                openRefs -= 1
+                    if openRefs:
+                        stack[-1][3] += 1
+                        continue
+                if not kept:
+                    elem.clear()
+                if stack:
+                    # attached siblings come first, the parser may
+                    # already have added the following ones
+                    parent = stack[-1][0]
+                    i = stack[-1][3]
+                    if parent[i] is elem:
+                        del parent[i]
+                    else:
+                        parent.remove(elem)
+
+        # 'use' tags with forward references
+        for ident, node in self.pending_uses:
+            self.render_use(ident, node, self.add_path, [self.px2mm,0,0,self.px2mm,0,0])
+        self.pending_uses = []
+        self.refs = {}
+
+        # build result dictionary
+        parse_results = {'boundarys':self.boundarys, 'dpi':self.dpi}
+        if self.lasertags:
+            parse_results['lasertags'] = self.lasertags
+
+        return parse_results
 
-        # parse xml
-        svgRootElement = ET.fromstring(svgstring)
-        tagName = self._tagReader._get_tag(svgRootElement)
 
-        if tagName != 'svg':
-            log.error("Invalid file, no 'svg' tag found.")
-            return self.boundarys
 
+    def parse_root(self, svgRootElement, svghead, force_dpi=None):
+        """Set up dpi and tolerances from the svg tag, return the root node."""
         # 1. Get px unit DPIs from argument
         if force_dpi is not None:
             self.dpi = force_dpi
@@ -171,7 +298,6 @@ class SVGReader:
         # 3. Try to get px unit DPIs from hints about the originating SVG app
         if not self.dpi:
             # look for clues  of svg generator app and it's DPI
-            svghead = svgstring[0:400]
             if 'Inkscape' in svghead:
                 self.dpi = 90.0
                 log.info("SVG exported with Inkscape -> 90dpi.")      
@@ -214,10 +340,8 @@ class SVGReader:
         # adjust tolerances to px units
         self.tolerance2_px = (self.tolerance/self.px2mm)*(self.tolerance/self.px2mm)
         
-        # let the fun begin
-        # recursively parse children
-        # output will be in self.boundarys    
-        node = {
+        # root of the inheritance chain
+        return {
             'xformToWorld': [1,0,0,1,0,0],
             'display': 'visible',
             'visibility': 'visible',
@@ -228,64 +352,169 @@ class SVGReader:
             'stroke-opacity': 1.0,
             'opacity': 1.0
         }
-        self.parse_children(svgRootElement, node)
-        
-        # build result dictionary
-        parse_results = {'boundarys':self.boundarys, 'dpi':self.dpi}
-        if self.lasertags:
-            parse_results['lasertags'] = self.lasertags
-
-        return parse_results
 
 
-    
-    def parse_children(self, domNode, parentNode):
-        for child in domNode:
-            log.debug("considering tag: " + child.tag)
-            if self._tagReader.has_handler(child):
-                # 1. setup a new node
-                # and inherit from parent
-                node = {
-                    'paths': [],
-                    'xform': [1,0,0,1,0,0],
-                    'xformToWorld': parentNode['xformToWorld'],
-                    'display': parentNode.get('display'),
-                    'visibility': parentNode.get('visibility'),
-                    'fill': parentNode.get('fill'),
-                    'stroke': parentNode.get('stroke'),
-                    'color': parentNode.get('color'),
-                    'fill-opacity': parentNode.get('fill-opacity'),
-                    'stroke-opacity': parentNode.get('stroke-opacity'),
-                    'opacity': parentNode.get('opacity')
-                }
-
-                # 2. parse child 
-                # with current attributes and transformation
-                self._tagReader.read_tag(child, node)
-                
-                # 3. compile boundarys + conversions
-                for path in node['paths']:
-                    if path:  # skip if empty subpath
-                        # 3a.) convert to world coordinates and then to mm units
-                        for vert in path:
-                            # print isinstance(vert[0],float) and isinstance(vert[1],float)
-                            matrixApply(node['xformToWorld'], vert)
-                            vertexScale(vert, self.px2mm)
-                        # 3b.) sort output by color
-                        hexcolor = node['stroke']
-                        if hexcolor in self.boundarys:
-                            self.boundarys[hexcolor].append(path)
-                        else:
-                            self.boundarys[hexcolor] = [path]
-
-                # 4. any lasertags (cut settings)?
-                if node.has_key('lasertags'):
-                    self.lasertags.extend(node['lasertags'])
-            
-                # recursive call
-                self.parse_children(child, node)
+    def new_node(self, parentNode):
+        """Setup a new node and inherit from parent."""
+        return {
+            'paths': [],
+            'xform': [1,0,0,1,0,0],
+            'xformToWorld': parentNode['xformToWorld'],
+            'display': parentNode.get('display'),
+            'visibility': parentNode.get('visibility'),
+            'fill': parentNode.get('fill'),
+            'stroke': parentNode.get('stroke'),
+            'color': parentNode.get('color'),
+            'fill-opacity': parentNode.get('fill-opacity'),
+            'stroke-opacity': parentNode.get('stroke-opacity'),
+            'opacity': parentNode.get('opacity')
+        }
 
 
+    def read_tag(self, tag, node):
+        """Parse a tag into node and add its paths to self.boundarys."""
+        # 1. parse with current attributes and transformation
+        self._tagReader.read_tag(tag, node)
+
+        # 2. compile boundarys + conversions
+        # world coordinates and mm units in one matrix
+        xformToMM = None
+        if node['paths']:
+            xformToMM = matrixMult([self.px2mm,0,0,self.px2mm,0,0], node['xformToWorld'])
+        for path in node['paths']:
+            if path:  # skip if empty subpath
+                # 2a.) convert to world coordinates and then to mm units
+                matrixApply(xformToMM, path)
+                # 2b.) sort output by color
+                self.add_path(node['stroke'], path)
+        node['paths'] = []
+
+        # 3. any lasertags (cut settings)?
+        if node.has_key('lasertags'):
+            self.lasertags.extend(node['lasertags'])
+
+
+
+    def add_path(self, hexcolor, path):
+        if hexcolor in self.boundarys:
+            self.boundarys[hexcolor].append(path)
+        else:
+            self.boundarys[hexcolor] = [path]
+
+
+    def read_use(self, tag, node):
+        """Parse a 'use' tag and draw the referenced element."""
+        self._tagReader.read_tag(tag, node)
+        href = tag.get(XLINK_HREF) or tag.get('href') or ''
+        if not href.startswith('#'):
+            log.warn("'use' of external or missing reference ignored: " + href)
+            return
+        ident = href[1:]
+        if ident in self.refs:
+            self.render_use(ident, node, self.add_path, [self.px2mm,0,0,self.px2mm,0,0])
+        else:
+            # defined later in the document
+            self.pending_uses.append((ident, node))
+
+
+    def render_use(self, ident, node, add_path, xformToOut):
+        """Draw the element with id ident as instance of a 'use' node.
+
+        The referenced content is tessellated once per scale bucket
+        (power of two at or above the node's scale) and inherited style.
+        Instances copy these paths and transform them with
+        xformToOut*node['xformToWorld'] before calling add_path.
+        """
+        elem = self.refs.get(ident)
+        if elem is None:
+            log.warn("'use' references unknown or too big element: " + ident)
+            return
+        if ident in self.expanding:
+            log.warn("'use' references itself, ignored: " + ident)
+            return
+        scale = _matrixMaxScale(node['xformToWorld'])
+        if scale == 0:
+            return
+        bucket = 2.0**math.ceil(math.log(scale, 2))
+        key = (ident, bucket, tuple([node.get(k) for k in INHERITED_STYLE]))
+        paths = self.ref_cache.get(key)
+        if paths is None:
+            paths = []
+            def add_ref_path(hexcolor, path):
+                paths.append((hexcolor, path))
+            refNode = self.new_node(node)
+            refNode['xformToWorld'] = [bucket,0,0,bucket,0,0]
+            self.expanding.add(ident)
+            try:
+                self.read_ref(elem, refNode, add_ref_path, [1.0/bucket,0,0,1.0/bucket,0,0], True)
+            finally:
+                self.expanding.discard(ident)
+            self.ref_cache[key] = paths
+        xform = matrixMult(xformToOut, node['xformToWorld'])
+        for hexcolor, path in paths:
+            path = array('d', path)
+            matrixApply(xform, path)
+            add_path(hexcolor, path)
+
+
+    def read_ref(self, tag, parentNode, add_path, xformToOut, top=False):
+        """Read a referenced element and its children like read_tag."""
+        if not self._tagReader.has_handler(tag):
+            return
+        tagName = self._tagReader._get_tag(tag)
+        if tagName == 'text':
+            return  # no cut settings from instances
+        node = self.new_node(parentNode)
+        if tagName == 'use':
+            self._tagReader.read_tag(tag, node)
+            href = tag.get(XLINK_HREF) or tag.get('href') or ''
+            if href.startswith('#'):
+                self.render_use(href[1:], node, add_path, xformToOut)
+            return
+        self._tagReader.read_tag(tag, node)
+        if node['paths']:
+            xform = matrixMult(xformToOut, node['xformToWorld'])
+            for path in node['paths']:
+                if path:
+                    matrixApply(xform, path)
+                    add_path(node['stroke'], path)
+            node['paths'] = []
+        if tagName in self.skip_tags and not top:
+            return
+        for child in tag:
+            self.read_ref(child, node, add_path, xformToOut)
+
+
+
+def _elementBytes(elem):
+    # rough memory held by a parsed element, without its children
+    size = REF_ELEMENT_BYTES + len(elem.tag) + len(elem.text or '') + len(elem.tail or '')
+    for name, value in elem.attrib.iteritems():
+        size += len(name) + len(value)
+    return size
+
+
+def _matrixMaxScale(mat):
+    # scale of the dominant axis
+    sx = math.sqrt(mat[0]*mat[0] + mat[1]*mat[1])
+    sy = math.sqrt(mat[2]*mat[2] + mat[3]*mat[3])
+    return max(sx, sy)
+
+
+
+class HeadRecorder:
+    """File object wrapper keeping the first size bytes read."""
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._size = size
+        self.head = ''
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if len(self.head) < self._size:
+            self.head += data[:self._size-len(self.head)]
+        return data
 
 
 
@@ -33,6 +33,8 @@ class SVGTagReader:
             'ellipse': self.ellipse,
             'image': self.image,
             'defs': self.defs,
+            'symbol': self.symbol,
+            'use': self.use,
             'style': self.style,
             'text': True  # text is special, see read_tag func
         }
@@ -92,7 +94,7 @@ class SVGTagReader:
         # http://www.w3.org/TR/SVG11/shapes.html#PolygonElement
         # has transform and style attributes
         if self._has_valid_stroke(node):
-            d = ['M'] + node['points'] + ['z']
+            d = [('M', node['points']), ('z', [])]
             node['points'] = None
             self._pathReader.add_path(d, node)      
 
@@ -101,7 +103,7 @@ class SVGTagReader:
         # http://www.w3.org/TR/SVG11/shapes.html#PolylineElement
         # has transform and style attributes
         if self._has_valid_stroke(node):
-            d = ['M'] + node['points']
+            d = [('M', node['points'])]
             node['points'] = None
             self._pathReader.add_path(d, node)  
 
@@ -110,29 +112,32 @@ class SVGTagReader:
         # http://www.w3.org/TR/SVG11/shapes.html#RectElement
         # has transform and style attributes      
         if self._has_valid_stroke(node):
-            w = node.get('width') or 0
-            h = node.get('height') or 0
-            x = node.get('x') or 0
-            y = node.get('y') or 0
+            w = node.get('width') or 0.0
+            h = node.get('height') or 0.0
+            x = node.get('x') or 0.0
+            y = node.get('y') or 0.0
             rx = node.get('rx')
             ry = node.get('ry')
-            if rx is None or ry is None:  # no rounded corners
-                d = ['M', x, y, 'h', w, 'v', h, 'h', -w, 'z']
+            if rx is None and ry is None:  # no rounded corners
+                d = [('M', [x, y]), ('h', [w]), ('v', [h]), ('h', [-w]), ('z', [])]
                 self._pathReader.add_path(d, node)
             else:                         # rounded corners
-                if 'ry' is None: ry = rx
+                if ry is None: ry = rx
+                if rx is None: rx = ry
                 if rx < 0.0: rx *=-1
                 if ry < 0.0: ry *=-1
-                d = ['M', x+rx , y ,
-                     'h', w-2*rx,
-                     'c', rx, 0.0, rx, ry, rx, ry,
-                     'v', h-ry,
-                     'c', '0.0', ry, -rx, ry, -rx, ry,
-                     'h', -w+2*rx,
-                     'c', -rx, '0.0', -rx, -ry, -rx, -ry,
-                     'v', -h+ry,
-                     'c', '0.0','0.0','0.0', -ry, rx, -ry,
-                     'z']
+                rx = min(rx, 0.5*w)
+                ry = min(ry, 0.5*h)
+                d = [('M', [x+rx, y]),
+                     ('h', [w-2*rx]),
+                     ('a', [rx, ry, 0.0, 0.0, 1.0, rx, ry]),
+                     ('v', [h-2*ry]),
+                     ('a', [rx, ry, 0.0, 0.0, 1.0, -rx, ry]),
+                     ('h', [-w+2*rx]),
+                     ('a', [rx, ry, 0.0, 0.0, 1.0, -rx, -ry]),
+                     ('v', [-h+2*ry]),
+                     ('a', [rx, ry, 0.0, 0.0, 1.0, rx, -ry]),
+                     ('z', [])]
                 self._pathReader.add_path(d, node)        
 
 
@@ -140,11 +145,11 @@ class SVGTagReader:
         # http://www.w3.org/TR/SVG11/shapes.html#LineElement
         # has transform and style attributes
         if self._has_valid_stroke(node):
-            x1 = node.get('x1') or 0
-            y1 = node.get('y1') or 0
-            x2 = node.get('x2') or 0
-            y2 = node.get('y2') or 0      
-            d = ['M', x1, y1, 'L', x2, y2]
+            x1 = node.get('x1') or 0.0
+            y1 = node.get('y1') or 0.0
+            x2 = node.get('x2') or 0.0
+            y2 = node.get('y2') or 0.0
+            d = [('M', [x1, y1]), ('L', [x2, y2])]
             self._pathReader.add_path(d, node)        
 
 
@@ -153,15 +158,15 @@ class SVGTagReader:
         # has transform and style attributes      
         if self._has_valid_stroke(node):
             r = node.get('r')
-            cx = node.get('cx') or 0
-            cy = node.get('cy') or 0
+            cx = node.get('cx') or 0.0
+            cy = node.get('cy') or 0.0
             if r > 0.0:
-                d = ['M', cx-r, cy,                  
-                     'A', r, r, 0, 0, 0, cx, cy+r,
-                     'A', r, r, 0, 0, 0, cx+r, cy,
-                     'A', r, r, 0, 0, 0, cx, cy-r,
-                     'A', r, r, 0, 0, 0, cx-r, cy,
-                     'Z']
+                d = [('M', [cx-r, cy]),
+                     ('A', [r, r, 0.0, 0.0, 0.0, cx, cy+r,
+                            r, r, 0.0, 0.0, 0.0, cx+r, cy,
+                            r, r, 0.0, 0.0, 0.0, cx, cy-r,
+                            r, r, 0.0, 0.0, 0.0, cx-r, cy]),
+                     ('Z', [])]
                 self._pathReader.add_path(d, node)
 
 
@@ -170,15 +175,15 @@ class SVGTagReader:
         if self._has_valid_stroke(node):
             rx = node.get('rx')
             ry = node.get('ry')
-            cx = node.get('cx') or 0
-            cy = node.get('cy') or 0        
+            cx = node.get('cx') or 0.0
+            cy = node.get('cy') or 0.0
             if rx > 0.0 and ry > 0.0:
-                d = ['M', cx-rx, cy,                  
-                     'A', rx, ry, 0, 0, 0, cx, cy+ry,
-                     'A', rx, ry, 0, 0, 0, cx+rx, cy,
-                     'A', rx, ry, 0, 0, 0, cx, cy-ry,
-                     'A', rx, ry, 0, 0, 0, cx-rx, cy,
-                     'Z']          
+                d = [('M', [cx-rx, cy]),
+                     ('A', [rx, ry, 0.0, 0.0, 0.0, cx, cy+ry,
+                            rx, ry, 0.0, 0.0, 0.0, cx+rx, cy,
+                            rx, ry, 0.0, 0.0, 0.0, cx, cy-ry,
+                            rx, ry, 0.0, 0.0, 0.0, cx-rx, cy]),
+                     ('Z', [])]
                 self._pathReader.add_path(d, node)
 
 
@@ -189,10 +194,29 @@ class SVGTagReader:
 
 
     def defs(self, node):
-        # not supported
         # http://www.w3.org/TR/SVG11/struct.html#Head
-        # has transform and style attributes      
-        log.warn("'defs' tag is not supported, ignored")     
+        # has transform and style attributes
+        # not rendered, content only gets drawn through 'use' tags
+        pass
+
+
+    def symbol(self, node):
+        # http://www.w3.org/TR/SVG11/struct.html#SymbolElement
+        # has style attributes, viewBox is not supported
+        # not rendered, content only gets drawn through 'use' tags
+        pass
+
+
+    def use(self, node):
+        # http://www.w3.org/TR/SVG11/struct.html#UseElement
+        # has transform and style attributes
+        # x, y translate the referenced element, it is drawn by
+        # SVGReader (the reference is not resolvable from here)
+        x = node.get('x') or 0.0
+        y = node.get('y') or 0.0
+        if x or y:
+            node['xformToWorld'] = matrixMult(node['xformToWorld'], [1,0,0,1,x,y])
+
 
     def style(self, node):
         # not supported: embedded style sheets
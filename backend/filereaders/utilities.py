@@ -1,6 +1,23 @@
 
 import re
+from array import array
+from itertools import izip
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_MIN_COORDS = 256  # below this numpy overhead outweighs the gain
+
+
+
+# a float in svg notation, also matches '.5', '+1' and '1e-5' and
+# splits compact forms like '1.5.5' and '1-2' into two numbers
+NUMBER_RE = re.compile(r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?')
+
+# path data as (command letter, argument string) pairs
+PATH_COMMAND_RE = re.compile(r'([MmZzLlHhVvCcSsQqTtAa])([^MmZzLlHhVvCcSsQqTtAa]*)')
 
 
 def parseFloats(float_strings):
@@ -8,10 +25,18 @@ def parseFloats(float_strings):
 
 	The function can deal with pretty much any separation chars.
 	"""
-	float_strings = re.findall('(-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)', float_strings)
-	for i in range(len(float_strings)):  # use index so we can edit in-place
-		float_strings[i] = float(float_strings[i])
-	return float_strings
+	return map(float, NUMBER_RE.findall(float_strings))
+
+
+def parsePathData(d_string):
+	"""Convert svg path data to a list of (command, args) tuples.
+
+	"M10,10 l5.5.5z" becomes [('M',(10.0,10.0)), ('l',(5.5,0.5)), ('z',())]
+	Numbers before the first command are dropped. Args are tuples,
+	unlike lists the garbage collector stops tracking them.
+	"""
+	findNumbers = NUMBER_RE.findall
+	return [(cmd, tuple(map(float, findNumbers(args)))) for cmd, args in PATH_COMMAND_RE.findall(d_string)]
 
 
 def matrixMult(mA, mB):
@@ -23,15 +48,39 @@ def matrixMult(mA, mB):
                      mA[1]*mB[4] + mA[3]*mB[5] + mA[5] ]
 
 
-def matrixApply(mat, vec):
-    vec[0] = mat[0]*vec[0] + mat[2]*vec[1] + mat[4]
-    vec[1] = mat[1]*vec[0] + mat[3]*vec[1] + mat[5]
-
+def matrixApply(mat, path):
+    """Transform a packed [x0,y0,x1,y1,...] path in-place."""
+    a, b, c, d, e, f = mat
+    if numpy is not None and len(path) > NUMPY_MIN_COORDS:
+        v = numpy.frombuffer(path).reshape(-1, 2)
+        x = v[:,0].copy()
+        y = v[:,1]
+        v[:,0] = a*x + c*y + e
+        v[:,1] = b*x + d*y + f
+    elif b == 0 and c == 0:
+        # no rotation or skew, the common case
+        if a != 1 or e != 0:
+            path[0::2] = array('d', [a*x + e for x in path[0::2]])
+        if d != 1 or f != 0:
+            path[1::2] = array('d', [d*y + f for y in path[1::2]])
+    else:
+        xs = path[0::2]
+        ys = path[1::2]
+        path[0::2] = array('d', [a*x + c*y + e for x, y in izip(xs, ys)])
+        path[1::2] = array('d', [b*x + d*y + f for x, y in izip(xs, ys)])
 
-def vertexScale(v, f):
-    v[0] *= f
-    v[1] *= f
 
+def vertexScale(path, f):
+    """Scale a packed path in-place."""
+    path[:] = array('d', [v*f for v in path])
 
 
+def reversePath(path):
+    """Reverse the vertex order of a packed path in-place."""
+    xs = path[0::2]
+    ys = path[1::2]
+    xs.reverse()
+    ys.reverse()
+    path[0::2] = xs
+    path[1::2] = ys
 
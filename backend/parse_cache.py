@@ -0,0 +1,153 @@
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# bump when reader output changes so stale disk entries are not used
+CACHE_VERSION = 1
+
+
+
+class ParseCache:
+    """Cache of file import results by content hash and parse settings.
+
+    Results are kept as the json string sent to the frontend, in an
+    LRU dict in memory and as files in directory (if not None). The
+    disk tier keeps the disk_size most recently used entries.
+
+    Usage:
+    key = parse_cache.key(hashlib.sha1(filedata).hexdigest(), dpi, optimize)
+    jsondata = parse_cache.get(key)
+    if jsondata is None:
+        jsondata = json.dumps(parse(filedata))
+        parse_cache.put(key, jsondata)
+    """
+
+    def __init__(self, directory=None, size=16, disk_size=256):
+        self.directory = directory
+        self.size = size
+        self.disk_size = disk_size
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def key(self, content_hash, *settings):
+        """Key for content (hex digest) parsed with settings (json-able)."""
+        params = json.dumps([CACHE_VERSION] + list(settings))
+        return hashlib.sha1(content_hash + params).hexdigest()
+
+
+    def get(self, key):
+        with self._lock:
+            jsondata = self._memory.pop(key, None)
+            if jsondata is not None:
+                self._memory[key] = jsondata  # most recently used
+                self.hits += 1
+                return jsondata
+        jsondata = self._read(key)
+        with self._lock:
+            if jsondata is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, jsondata)
+        return jsondata
+
+
+    def put(self, key, jsondata):
+        with self._lock:
+            self._remember(key, jsondata)
+        self._write(key, jsondata)
+
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        for filename in self._disk_files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'memory_entries': len(self._memory)}
+
+
+    def _remember(self, key, jsondata):
+        self._memory.pop(key, None)
+        self._memory[key] = jsondata
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+
+    def _disk_files(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                if f.endswith('.json')]
+
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        filename = self._path(key)
+        try:
+            fp = open(filename, 'rb')
+            try:
+                jsondata = fp.read()
+            finally:
+                fp.close()
+            os.utime(filename, None)  # mtime marks recent use
+            return jsondata
+        except (IOError, OSError):
+            return None
+
+
+    def _write(self, key, jsondata):
+        if not self.directory:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            # write and rename so readers never see partial files
+            filename = self._path(key)
+            tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+            fp = open(tmpname, 'wb')
+            try:
+                fp.write(jsondata)
+            finally:
+                fp.close()
+            if os.path.exists(filename):
+                os.remove(filename)  # windows does not replace on rename
+            os.rename(tmpname, filename)
+            self._prune()
+        except (IOError, OSError), e:
+            print "parse cache write failed: " + str(e)
+
+
+    def _prune(self):
+        files = self._disk_files()
+        if len(files) <= self.disk_size:
+            return
+        def mtime(filename):
+            try:
+                return os.path.getmtime(filename)
+            except OSError:
+                return 0  # removed meanwhile
+        files.sort(key=mtime)
+        for filename in files[:len(files)-self.disk_size]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
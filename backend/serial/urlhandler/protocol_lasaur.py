@@ -0,0 +1,422 @@
+#! python
+#
+# Python Serial Port Extension for Win32, Linux, BSD, Jython
+# see __init__.py
+#
+# This module implements a simulated LasaurGrbl controller. It models
+# the firmware's side of the serial protocol so the streaming code of
+# LasaurApp can be run, benchmarked and regression-tested without any
+# hardware attached.
+#
+# What is modeled:
+# - the wire, bytes arrive at baudrate/10 bytes per second
+# - the firmware rx buffer (default 255 bytes), writing more than was
+#   requested overflows it and puts the machine into stop mode ('B')
+# - flow control, a ready char ('\x12') grants the host one chunk
+#   (TX_CHUNK_SIZE bytes) once the previous chunk has arrived and there
+#   is room for it, '\x14' requests a new ready char
+# - the planner consuming lines at a fixed rate (lines per second)
+# - forward error correction, '^' and '*' framed lines with checksum,
+#   reporting corrections with a '^' line and failures as stop 'T'
+# - real-time chars '!' (stop, 'R') and '~' (resume from stop)
+# - status reports in response to '?'
+#
+# URL format:    lasaur://[option[/option...]]
+# options:
+# - "rx=N"       size of the rx buffer (default: 255)
+# - "chunk=N"    bytes granted per ready char (default: 64)
+# - "lps=N"      lines per second consumed by the planner, 0 for no
+#                limit (default: 2000)
+# - "noise=P"    probability of corrupting a byte on the wire (default: 0)
+# - "logging=LEVEL" log diagnostic messages
+
+from serial.serialutil import *
+import threading
+import random
+import time
+import logging
+
+# map log level names to constants. used in fromURL()
+LOGGER_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    }
+
+READY_CHAR = '\x12'
+REQUEST_READY_CHAR = '\x14'
+STOP_CHAR = '!'
+RESUME_CHAR = '~'
+FIRMWARE_VERSION = '13.01-sim'
+
+
+def fec_checksum(line):
+    """Checksum over the line as computed by LasaurGrbl."""
+    checksum = 0
+    for c in line:
+        if ord(c) > ord(' ') and c != '~' and c != '!':
+            checksum += ord(c)
+            if checksum >= 128:
+                checksum -= 128
+    return chr((checksum >> 1) + 128)
+
+
+class LasaurSimSerial(SerialBase):
+    """Serial port implementation that simulates a LasaurGrbl controller."""
+
+    BAUDRATES = (9600, 19200, 38400, 57600, 115200, 230400)
+
+    TICK = 0.001  # simulation step in seconds
+
+    def open(self):
+        """Open port with current settings. This may throw a SerialException
+           if the port cannot be opened."""
+        if self._isOpen:
+            raise SerialException("Port is already open.")
+        self.logger = None
+        self.rx_size = 255
+        self.chunk_size = 64
+        self.lines_per_sec = 2000.0
+        self.noise = 0.0
+
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        self.fromURL(self.port)
+        self._reconfigurePort()
+
+        # host -> firmware
+        self.wire = bytearray()       # written, not yet arrived
+        self.rx_buffer = bytearray()  # firmware rx buffer
+        self.granted = 0              # bytes allowed by sent ready chars
+        # firmware -> host
+        self.out_buffer = bytearray()
+        self.cond = threading.Condition()
+
+        # firmware state
+        self.stop_code = ''
+        self.fec_skip_next = False
+        self.fec_corrected = False
+        self.pos = {'X': 0.0, 'Y': 0.0}
+        self.lines_done = 0
+
+        self._isOpen = True
+        self.out_buffer += '# LasaurGrbl ' + FIRMWARE_VERSION + ' (simulated)\n'
+        self.sim_thread = threading.Thread(target=self._run)
+        self.sim_thread.daemon = True
+        self.sim_thread.start()
+
+    def _reconfigurePort(self):
+        """Set communication parameters on opened port. Only the baudrate
+        is used, to model the time bytes spend on the wire."""
+        if not isinstance(self._baudrate, (int, long)) or not 0 < self._baudrate < 2**32:
+            raise ValueError("invalid baudrate: %r" % (self._baudrate))
+        if self.logger:
+            self.logger.info('_reconfigurePort()')
+
+    def close(self):
+        """Close port"""
+        if self._isOpen:
+            self._isOpen = False
+            self.cond.acquire()
+            self.cond.notifyAll()
+            self.cond.release()
+            self.sim_thread.join()
+
+    def makeDeviceName(self, port):
+        raise SerialException("there is no sensible way to turn numbers into URLs")
+
+    def fromURL(self, url):
+        """extract options from an URL string"""
+        if url.lower().startswith("lasaur://"): url = url[9:]
+        try:
+            # process options now, directly altering self
+            for option in url.split('/'):
+                if '=' in option:
+                    option, value = option.split('=', 1)
+                else:
+                    value = None
+                if not option:
+                    pass
+                elif option == 'logging':
+                    logging.basicConfig()   # XXX is that good to call it here?
+                    self.logger = logging.getLogger('pySerial.lasaur')
+                    self.logger.setLevel(LOGGER_LEVELS[value])
+                    self.logger.debug('enabled logging')
+                elif option == 'rx':
+                    self.rx_size = int(value)
+                elif option == 'chunk':
+                    self.chunk_size = int(value)
+                elif option == 'lps':
+                    self.lines_per_sec = float(value)
+                elif option == 'noise':
+                    self.noise = float(value)
+                else:
+                    raise ValueError('unknown option: %r' % (option,))
+        except (TypeError, ValueError), e:
+            raise SerialException('expected a string in the form "[lasaur://][option[/option...]]": %s' % e)
+
+    #  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+    # firmware simulation, runs on its own thread
+
+    def _run(self):
+        bytes_per_sec = self._baudrate/10.0
+        last = time.time()
+        wire_budget = 0.0
+        line_budget = 0.0
+        while self._isOpen:
+            time.sleep(self.TICK)
+            now = time.time()
+            dt = now - last
+            last = now
+            self.cond.acquire()
+            try:
+                # bytes arriving over the wire
+                wire_budget = min(wire_budget + dt*bytes_per_sec, len(self.wire))
+                n = int(wire_budget)
+                if n > 0:
+                    wire_budget -= n
+                    arrived = self.wire[:n]
+                    del self.wire[:n]
+                    for c in arrived:
+                        self._receive_char(chr(c))
+                # planner consuming lines
+                if self.lines_per_sec > 0:
+                    line_budget = min(line_budget + dt*self.lines_per_sec, 100.0)
+                else:
+                    line_budget = 100.0
+                while line_budget >= 1.0 and self._process_line():
+                    line_budget -= 1.0
+                # flow control, one outstanding chunk at a time
+                free = self.rx_size - len(self.rx_buffer)
+                if not self.stop_code and self.granted == 0 and free >= self.chunk_size:
+                    self.granted += self.chunk_size
+                    self._emit(READY_CHAR)
+            finally:
+                self.cond.release()
+
+    def _receive_char(self, c):
+        if c == STOP_CHAR:
+            self._stop('R')
+        elif c == RESUME_CHAR:
+            self.stop_code = ''
+            self.rx_buffer = bytearray()
+            self.granted = 0
+        elif c == REQUEST_READY_CHAR:
+            # host lost track, grant again if there is room
+            self.granted = 0
+        elif self.stop_code:
+            pass  # in stop mode everything else is discarded
+        elif len(self.rx_buffer) >= self.rx_size:
+            self._stop('B')  # buffer overflow
+        else:
+            if self.noise and c != '\n' and random.random() < self.noise:
+                c = chr(ord(c) ^ 0x01)
+            self.rx_buffer.append(c)
+            if self.granted > 0:
+                self.granted -= 1
+
+    def _process_line(self):
+        """Consume one line from the rx buffer, return False if none."""
+        pos = self.rx_buffer.find('\n')
+        if pos == -1:
+            return False
+        line = str(self.rx_buffer[:pos])
+        del self.rx_buffer[:pos+1]
+        if line and line[0] in '^*' and len(line) > 1:
+            marker, checksum, line = line[0], line[1], line[2:]
+            if marker == '^':
+                if checksum == fec_checksum(line):
+                    self.fec_skip_next = True
+                    self._execute(line)
+                else:
+                    self.fec_corrected = True
+                return True
+            else:  # '*'
+                if self.fec_skip_next:
+                    self.fec_skip_next = False
+                    return True
+                if checksum != fec_checksum(line):
+                    self._stop('T')  # transmission error
+                    return True
+                if self.fec_corrected:
+                    self.fec_corrected = False
+                    self._emit('^\n')
+        self._execute(line)
+        return True
+
+    def _execute(self, line):
+        line = line.strip()
+        if not line:
+            return
+        self.lines_done += 1
+        if line == '?':
+            self._emit(self._status_line())
+        elif line[0] in 'GM':
+            # track position, enough for status reports
+            for axis in 'XY':
+                i = line.find(axis)
+                if i != -1:
+                    j = i+1
+                    while j < len(line) and line[j] in '0123456789.-':
+                        j += 1
+                    try:
+                        self.pos[axis] = float(line[i+1:j])
+                    except ValueError:
+                        self._stop('N')  # bad number format
+
+    def _status_line(self):
+        status = ''
+        if self.stop_code:
+            status += '!' + self.stop_code
+        status += 'X%.2fY%.2f' % (self.pos['X'], self.pos['Y'])
+        return status + 'V' + FIRMWARE_VERSION + '\n'
+
+    def _stop(self, code):
+        if self.logger:
+            self.logger.info('stop mode: %s' % (code,))
+        self.stop_code = code
+        self.rx_buffer = bytearray()
+        self.granted = 0
+        self.fec_skip_next = False
+        self._emit('!' + code + '\n')
+
+    def _emit(self, data):
+        # caller holds self.cond
+        self.out_buffer += data
+        self.cond.notifyAll()
+
+    #  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+
+    def inWaiting(self):
+        """Return the number of characters currently in the input buffer."""
+        if not self._isOpen: raise portNotOpenError
+        return len(self.out_buffer)
+
+    def read(self, size=1):
+        """Read size bytes from the serial port. If a timeout is set it may
+        return less characters as requested. With no timeout it will block
+        until the requested number of bytes is read."""
+        if not self._isOpen: raise portNotOpenError
+        if self._timeout is not None:
+            timeout = time.time() + self._timeout
+        else:
+            timeout = None
+        data = bytearray()
+        self.cond.acquire()
+        try:
+            while len(data) < size and self._isOpen:
+                block = self.out_buffer[:size-len(data)]
+                del self.out_buffer[:len(block)]
+                data += block
+                if len(data) >= size:
+                    break
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    timeleft = timeout - time.time()
+                    if timeleft <= 0:
+                        break
+                    self.cond.wait(timeleft)
+        finally:
+            self.cond.release()
+        return bytes(data)
+
+    def write(self, data):
+        """Output the given string over the serial port."""
+        if not self._isOpen: raise portNotOpenError
+        data = bytes(data)
+        self.cond.acquire()
+        try:
+            self.wire += data
+        finally:
+            self.cond.release()
+        return len(data)
+
+    def flushInput(self):
+        """Clear input buffer, discarding all that is in the buffer."""
+        if not self._isOpen: raise portNotOpenError
+        self.cond.acquire()
+        try:
+            del self.out_buffer[:]
+        finally:
+            self.cond.release()
+
+    def flushOutput(self):
+        """Clear output buffer, aborting the current output and
+        discarding all that is in the buffer."""
+        if not self._isOpen: raise portNotOpenError
+        self.cond.acquire()
+        try:
+            del self.wire[:]
+        finally:
+            self.cond.release()
+
+    def sendBreak(self, duration=0.25):
+        """Send break condition. Timed, returns to idle state after given
+        duration."""
+        if not self._isOpen: raise portNotOpenError
+
+    def setBreak(self, level=True):
+        """Set break: Controls TXD. When active, to transmitting is
+        possible."""
+        if not self._isOpen: raise portNotOpenError
+
+    def setRTS(self, level=True):
+        """Set terminal status line: Request To Send"""
+        if not self._isOpen: raise portNotOpenError
+
+    def setDTR(self, level=True):
+        """Set terminal status line: Data Terminal Ready"""
+        if not self._isOpen: raise portNotOpenError
+
+    def getCTS(self):
+        """Read terminal status line: Clear To Send"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    def getDSR(self):
+        """Read terminal status line: Data Set Ready"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    def getRI(self):
+        """Read terminal status line: Ring Indicator"""
+        if not self._isOpen: raise portNotOpenError
+        return False
+
+    def getCD(self):
+        """Read terminal status line: Carrier Detect"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    # - - - platform specific - - -
+    # None so far
+
+
+# assemble Serial class with the platform specific implementation and the base
+# for file-like behavior. for Python 2.6 and newer, that provide the new I/O
+# library, derive from io.RawIOBase
+try:
+    import io
+except ImportError:
+    # classic version with our own file-like emulation
+    class Serial(LasaurSimSerial, FileLike):
+        pass
+else:
+    # io library present
+    class Serial(LasaurSimSerial, io.RawIOBase):
+        pass
+
+
+# simple client test
+if __name__ == '__main__':
+    import sys
+    s = Serial('lasaur://', 57600, timeout=1.0)
+    sys.stdout.write('%s\n' % s)
+    sys.stdout.write("read: %r\n" % s.readline())
+    sys.stdout.write("write...\n")
+    s.write("?\n")
+    time.sleep(0.1)
+    sys.stdout.write("read: %r\n" % s.read(s.inWaiting()))
+    s.close()
@@ -2,9 +2,206 @@
 import os
 import sys
 import time
+import threading
+import traceback
+import Queue
+import bisect
 import serial
 from serial.tools import list_ports
 from collections import deque
+from itertools import islice
+
+
+# chars that do not count towards the FEC checksum: 32 and lower, ~, !
+FEC_IGNORE_CHARS = ''.join([chr(i) for i in range(33)]) + '~!'
+
+def fec_checksum(gcode):
+    """Checksum as computed by LasaurGrbl, returned as a char."""
+    values = bytearray(gcode.translate(None, FEC_IGNORE_CHARS))
+    if not values or max(values) < 128:
+        # all 7-bit, the per-char wrap at 128 is a plain modulo
+        checksum = sum(values) % 128
+    else:
+        checksum = 0
+        for ascii_ord in values:
+            checksum += ascii_ord
+            if checksum >= 128:
+                checksum -= 128
+    return chr((checksum >> 1) + 128)
+
+
+
+class TxQueue:
+    """FIFO of bytes waiting to be sent to the device.
+
+    Data is kept as a deque of string chunks plus a read offset into
+    the head chunk. Appending pushes a chunk and consuming advances
+    the offset (dropping exhausted chunks), so neither operation
+    copies the rest of the queue, no matter how big the job is.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._chunks = deque()
+        self._offset = 0  # read position in the head chunk
+        self._size = 0    # bytes queued but not yet consumed
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def peek(self, n):
+        """Return up to n bytes from the front without consuming them."""
+        if not self._chunks:
+            return ''
+        head = self._chunks[0]
+        end = self._offset + n
+        if end <= len(head) or len(self._chunks) == 1:
+            return head[self._offset:end]
+        # spans multiple chunks
+        parts = [head[self._offset:]]
+        n -= len(parts[0])
+        for chunk in islice(self._chunks, 1, None):
+            if n <= 0:
+                break
+            parts.append(chunk[:n])
+            n -= len(chunk)
+        return ''.join(parts)
+
+    def consume(self, n):
+        """Drop n bytes from the front, return how many were dropped."""
+        n = min(n, self._size)
+        self._size -= n
+        left = n
+        while left > 0:
+            remaining = len(self._chunks[0]) - self._offset
+            if left < remaining:
+                self._offset += left
+                break
+            left -= remaining
+            self._chunks.popleft()
+            self._offset = 0
+        return n
+
+
+
+class Histogram:
+    """Counts of values in fixed buckets, plus count, sum and max."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds  # upper bucket bounds, ascending
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*(len(self.bounds)+1)  # last one is overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        buckets = [('<=%g' % b, n) for b, n in zip(self.bounds, self.counts)]
+        buckets.append(('>%g' % self.bounds[-1], self.counts[-1]))
+        mean = 0.0
+        if self.count:
+            mean = self.total/self.count
+        return {'count': self.count, 'mean': mean, 'max': self.max,
+                'buckets': buckets}
+
+
+
+class SerialMetrics:
+    """Throughput and latency counters of the serial link.
+
+    All times are in seconds. Meant to tell whether the host or the
+    firmware is the bottleneck: a long ready_rtt and lots of starved
+    time mean the firmware is busy, long loop times or a low rate
+    with little starvation point at the host.
+    """
+
+    TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+    RATE_WINDOW = 1.0  # seconds over which the current rate is measured
+
+    def __init__(self):
+        self.ready_rtt = Histogram(self.TIME_BUCKETS)
+        self.loop_time = Histogram(self.TIME_BUCKETS)
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.ready_chars = 0
+        self.write_timeouts = 0
+        self.fec_corrections = 0
+        self.starved_time = 0.0
+        self.starved_since = None   # tx data waiting but nothing requested
+        self.ready_wait_since = None  # last chunk sent, waiting for ready
+        self.rate = 0.0
+        self._rate_time = self.started
+        self._rate_bytes = 0
+        self.ready_rtt.reset()
+        self.loop_time.reset()
+
+    def sent(self, n, now):
+        self.bytes_sent += n
+        if now - self._rate_time >= self.RATE_WINDOW:
+            self.rate = (self.bytes_sent - self._rate_bytes)/(now - self._rate_time)
+            self._rate_time = now
+            self._rate_bytes = self.bytes_sent
+
+    def ready(self, count, now):
+        self.ready_chars += count
+        if self.ready_wait_since is not None:
+            self.ready_rtt.add(now - self.ready_wait_since)
+            self.ready_wait_since = None
+
+    def starving(self, flag, now):
+        if flag:
+            if self.starved_since is None:
+                self.starved_since = now
+        elif self.starved_since is not None:
+            self.starved_time += now - self.starved_since
+            self.starved_since = None
+
+    def as_dict(self):
+        now = time.time()
+        elapsed = now - self.started
+        starved = self.starved_time
+        if self.starved_since is not None:
+            starved += now - self.starved_since
+        rate_avg = 0.0
+        if elapsed > 0:
+            rate_avg = self.bytes_sent/elapsed
+        rate = self.rate
+        if now - self._rate_time > 2*self.RATE_WINDOW:
+            rate = 0.0  # nothing sent lately
+        return {
+            'elapsed': elapsed,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'bytes_per_sec': rate,
+            'bytes_per_sec_avg': rate_avg,
+            'ready_chars': self.ready_chars,
+            'ready_rtt': self.ready_rtt.as_dict(),
+            'starved_time': starved,
+            'write_timeouts': self.write_timeouts,
+            'fec_corrections': self.fec_corrections,
+            'loop_time': self.loop_time.as_dict()
+        }
+
 
 
 class SerialManagerClass:
@@ -13,7 +210,7 @@ class SerialManagerClass:
         self.device = None
 
         self.rx_buffer = ""
-        self.tx_buffer = ""        
+        self.tx_buffer = TxQueue()
         self.remoteXON = True
 
         # TX_CHUNK_SIZE - this is the number of bytes to be 
@@ -22,9 +219,21 @@ class SerialManagerClass:
         self.RX_CHUNK_SIZE = 256
         self.nRequested = 0
         
+        # TX_LOW_WATER - pending job sources get encoded into the
+        # tx_buffer whenever it holds less than this many bytes
+        self.TX_LOW_WATER = 4096
+        self.ENCODE_BATCH = 256  # lines per encoded chunk
+        # generators of encoded data, not yet in the tx_buffer
+        self._sources = deque()
+
         # used for calculating percentage done
-        self.job_size = 0
+        self.job_size = 0        # bytes encoded
+        self.job_sent = 0        # bytes sent
+        self.job_lines = 0       # lines in pipelined job, 0 if unknown
+        self.job_lines_encoded = 0
         self.job_active = False
+        self.job_open = 0        # uploads with more parts to come
+        self.job_generation = 0  # bumped on every stop, see begin_job
 
         # status flags
         self.status = {}
@@ -33,11 +242,32 @@ class SerialManagerClass:
         self.LASAURGRBL_FIRST_STRING = "LasaurGrbl"
 
         self.fec_redundancy = 2  # use forward error correction
+        # memoized line frames, see encode_gcode_line
+        self._frame_cache = {}
+        self.FRAME_CACHE_SIZE = 10000
 
         self.ready_char = '\x12'
         self.request_ready_char = '\x14'
         self.last_request_ready = 0
 
+        # RX_TIMEOUT - how long a read blocks waiting for the device.
+        # This also bounds how long newly queued data may wait
+        # before the serial thread gets to it.
+        self.RX_TIMEOUT = 0.01
+
+        # serial I/O thread
+        # All device access happens on this thread once started.
+        # Other threads queue data under self.lock and pass device
+        # operations (connect, close, flush) through self._commands.
+        self.lock = threading.RLock()
+        self._commands = Queue.Queue()
+        self._command_lock = threading.Lock()  # guards started/abandoned
+        self._thread = None
+        self._running = False
+        self.COMMAND_TIMEOUT = 5.0  # max wait for a command to run
+
+        self.metrics = SerialMetrics()
+
 
 
     def reset_status(self):
@@ -111,24 +341,128 @@ class SerialManagerClass:
             return None      
         
 
+    def start(self):
+        """Run the serial I/O loop on its own thread."""
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._serial_loop, name="serial")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the serial thread, returns once it has finished."""
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+
+    def _serial_loop(self):
+        try:
+            while self._running:
+                try:
+                    # idle (no device or paused) -> wait on the command queue
+                    # instead of spinning on send_queue_as_ready
+                    idle = not self.device or self.status['paused']
+                    self._process_commands(idle)
+                    if self.device:
+                        t = time.time()
+                        self.send_queue_as_ready()
+                        self.metrics.loop_time.add(time.time() - t)
+                except Exception:
+                    # unexpected error, report it and drop the device
+                    # (like a serial error) but keep the thread alive
+                    sys.stdout.write("\nserial thread error:\n")
+                    traceback.print_exc()
+                    self._close()
+        finally:
+            # nobody is going to run queued commands anymore
+            self._running = False
+            self._fail_commands(serial.SerialException("serial thread stopped"))
+
+    def _process_commands(self, block):
+        try:
+            if block:
+                command = self._commands.get(timeout=0.1)
+            else:
+                command = self._commands.get_nowait()
+            while 1:
+                func, args, result = command
+                with self._command_lock:
+                    # the caller may have given up on it, see _call_on_serial_thread
+                    run = not result.get('abandoned')
+                    result['started'] = run
+                if run:
+                    try:
+                        result['value'] = func(*args)
+                    except Exception, e:
+                        result['error'] = e
+                    result['done'].set()
+                command = self._commands.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _fail_commands(self, error):
+        """Complete all queued commands with error, without running them."""
+        try:
+            while 1:
+                func, args, result = self._commands.get_nowait()
+                result['error'] = error
+                result['done'].set()
+        except Queue.Empty:
+            pass
+
+    def _call_on_serial_thread(self, func, *args):
+        """Run func on the serial thread and return its result.
+
+        Exceptions are re-raised in the calling thread. When the serial
+        thread is not running (or we are on it) this is a direct call.
+        Raises SerialException if the serial thread does not get to it
+        within COMMAND_TIMEOUT, the command is then dropped unrun.
+        """
+        if not self._running or threading.current_thread() is self._thread:
+            return func(*args)
+        result = {'done': threading.Event()}
+        self._commands.put((func, args, result))
+        if not result['done'].wait(self.COMMAND_TIMEOUT):
+            with self._command_lock:
+                if not result.get('started'):
+                    result['abandoned'] = True
+                    raise serial.SerialException("serial thread not responding")
+            # already running, let it finish
+            if not result['done'].wait(self.COMMAND_TIMEOUT):
+                raise serial.SerialException("serial command not finishing")
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+
     def connect(self, port, baudrate):
-        self.rx_buffer = ""
-        self.tx_buffer = ""        
-        self.remoteXON = True
-        self.job_size = 0
-        self.reset_status()
+        return self._call_on_serial_thread(self._connect, port, baudrate)
+
+    def _connect(self, port, baudrate):
+        with self.lock:
+            self.rx_buffer = ""
+            self.tx_buffer.clear()
+            self._sources.clear()
+            self.remoteXON = True
+            self._reset_job()
+            self.reset_status()
                 
-        # Create serial device with both read timeout set to 0.
-        # This results in the read() being non-blocking
+        # Create serial device with a short read timeout.
+        # Reads block for at most RX_TIMEOUT, see _read_available.
         # Write on the other hand uses a large timeout but should not be blocking
         # much because we ask it only to write TX_CHUNK_SIZE at a time.
         # BUG WARNING: the pyserial write function does not report how
         # many bytes were actually written if this is different from requested.
         # Work around: use a big enough timeout and a small enough chunk size.
-        self.device = serial.Serial(port, baudrate, timeout=0, writeTimeout=0.1)
+        # Ports can also be URLs like lasaur:// (firmware simulator).
+        self.device = serial.serial_for_url(port, baudrate, timeout=self.RX_TIMEOUT, writeTimeout=0.1)
 
 
     def close(self):
+        return self._call_on_serial_thread(self._close)
+
+    def _close(self):
         if self.device:
             try:
                 self.device.flushOutput()
@@ -146,23 +480,172 @@ class SerialManagerClass:
         return bool(self.device)
 
     def get_hardware_status(self):
-        if self.is_queue_empty():
-            # trigger a status report
-            # will update for the next status request
-            self.queue_gcode_line('?')
-        return self.status
+        with self.lock:
+            if self.is_queue_empty():
+                # trigger a status report
+                # will update for the next status request
+                self.queue_gcode_line('?')
+            return dict(self.status)
 
 
     def flush_input(self):
+        self._call_on_serial_thread(self._flush_input)
+
+    def _flush_input(self):
         if self.device:
             self.device.flushInput()
 
     def flush_output(self):
+        self._call_on_serial_thread(self._flush_output)
+
+    def _flush_output(self):
         if self.device:
             self.device.flushOutput()
 
 
+    def encode_gcode_line(self, gcode):
+        """Frame a stripped gcode line for sending.
+
+        With FEC each line goes out fec_redundancy times, prefixed by
+        a marker ('^' for the redundant copies, '*' for the last one)
+        and the checksum char. Frames are memoized because raster
+        passes repeat the same lines over and over.
+        """
+        frame = self._frame_cache.get(gcode)
+        if frame is None:
+            if self.fec_redundancy > 0:  # using error correction
+                checksum = fec_checksum(gcode)
+                frame = ('^' + checksum + gcode + '\n')*(self.fec_redundancy-1) \
+                        + '*' + checksum + gcode + '\n'
+            else:
+                frame = gcode + '\n'
+            if len(self._frame_cache) >= self.FRAME_CACHE_SIZE:
+                self._frame_cache.clear()
+            self._frame_cache[gcode] = frame
+        return frame
+
+
     def queue_gcode_line(self, gcode):
+        with self.lock:
+            self._queue_gcode_line(gcode)
+
+    def queue_gcode_program(self, lines, job=None):
+        """Queue a whole program (any iterable of lines) in one go.
+
+        Lines are encoded into a single chunk and appended to the
+        tx_buffer at once, which is a lot cheaper than queueing
+        them one by one.
+
+        job is the token from begin_job. When the job got stopped in
+        the meantime the lines are dropped and False is returned, the
+        caller should stop sending more parts then. A '!' among the
+        lines stops the job as well.
+        """
+        frames = []
+        ready = True
+        for line in lines:
+            gcode = line.strip()
+            if not gcode or gcode[0] == '%':
+                continue
+            elif gcode[0] == '!':
+                # stop request, discards everything queued before
+                frames = []
+                self.queue_gcode_line(gcode)
+            else:
+                if gcode != '?':
+                    ready = False
+                frames.append(self.encode_gcode_line(gcode))
+        with self.lock:
+            if job is not None and job != self.job_generation:
+                return False
+            if frames and self.is_connected():
+                if not ready:
+                    self.status['ready'] = False
+                self._enqueue(''.join(frames))
+        return True
+
+    def begin_job(self):
+        """Start a job that gets queued in parts, e.g. while uploading.
+
+        The job stays active until end_job, even when the tx_buffer
+        runs dry between two parts. Otherwise every gap would end the
+        job and restart the progress.
+
+        Returns a token for queue_gcode_program. Stopping the machine
+        invalidates it, so parts still arriving after a stop get
+        dropped instead of running after the resume.
+        """
+        with self.lock:
+            self.job_open += 1
+            self.job_active = True
+            self.status['ready'] = False
+            return self.job_generation
+
+    def end_job(self, job=None):
+        """All parts queued, the job ends once they are sent."""
+        with self.lock:
+            # a stop already closed all jobs of older generations
+            if job is None or job == self.job_generation:
+                self.job_open = max(0, self.job_open - 1)
+
+    def queue_gcode_stream(self, lines, line_count=0):
+        """Queue a program for pipelined sending.
+
+        The lines are not encoded here. The serial thread encodes them
+        batch by batch whenever the tx_buffer runs low, so the first
+        commands go out right away. Pass line_count (if known) for
+        get_queue_progress to report encoding progress.
+        """
+        if self.is_connected():
+            with self.lock:
+                self.status['ready'] = False
+                self.job_lines += line_count
+                self.job_active = True
+                self._sources.append(self._encode_source(lines))
+
+    def _encode_source(self, lines):
+        """Generator of encoded chunks, used by queue_gcode_stream."""
+        frames = []
+        for line in lines:
+            self.job_lines_encoded += 1
+            gcode = line.strip()
+            if not gcode or gcode[0] == '%':
+                continue
+            elif gcode[0] == '!':
+                # stop request, cancels this job too
+                self._queue_gcode_line(gcode)
+                return
+            frames.append(self.encode_gcode_line(gcode))
+            if len(frames) >= self.ENCODE_BATCH:
+                yield ''.join(frames)
+                frames = []
+        if frames:
+            yield ''.join(frames)
+
+    def _enqueue(self, data):
+        # keep order with pending job sources
+        if self._sources:
+            self._sources.append(iter([data]))
+        else:
+            self.tx_buffer.append(data)
+            self.job_size += len(data)
+        self.job_active = True
+
+    def _refill(self):
+        """Move encoded data from job sources into the tx_buffer."""
+        while self._sources and len(self.tx_buffer) < self.TX_LOW_WATER:
+            source = self._sources[0]
+            try:
+                data = source.next()
+            except StopIteration:
+                if self._sources and self._sources[0] is source:
+                    self._sources.popleft()
+                continue
+            if self._sources and self._sources[0] is source:
+                self.tx_buffer.append(data)
+                self.job_size += len(data)
+
+    def _queue_gcode_line(self, gcode):
         if gcode and self.is_connected():
             gcode = gcode.strip()
     
@@ -170,54 +653,82 @@ class SerialManagerClass:
                 return
             elif gcode[0] == '!':
                 self.cancel_queue()
+                # same firmware after a stop, keep its version
+                version = self.status['firmware_version']
                 self.reset_status()
-                self.tx_buffer = '!\n'
-                self.job_size = 2
-                self.job_active = True
+                self.status['firmware_version'] = version
+                self._enqueue('!\n')
             else:
                 if gcode != '?':  # not ready unless just a ?-query
                     self.status['ready'] = False
-                    
-                if self.fec_redundancy > 0:  # using error correction
-                    # prepend marker and checksum
-                    checksum = 0
-                    for c in gcode:
-                        ascii_ord = ord(c)
-                        if ascii_ord > ord(' ') and c != '~' and c != '!':  #ignore 32 and lower, ~, !
-                            checksum += ascii_ord
-                            if checksum >= 128:
-                                checksum -= 128
-                    checksum = (checksum >> 1) + 128
-                    gcode_redundant = ""
-                    for n in range(self.fec_redundancy-1):
-                        gcode_redundant += '^' + chr(checksum) + gcode + '\n'
-                    gcode = gcode_redundant + '*' + chr(checksum) + gcode
-
-                self.tx_buffer += gcode + '\n'
-                self.job_size += len(gcode) + 1
-                self.job_active = True
+                self._enqueue(self.encode_gcode_line(gcode))
 
 
 
     def cancel_queue(self):
-        self.tx_buffer = ''
+        with self.lock:
+            self.tx_buffer.clear()
+            self._sources.clear()
+            self._reset_job()
+
+    def _reset_job(self):
         self.job_size = 0
+        self.job_sent = 0
+        self.job_lines = 0
+        self.job_lines_encoded = 0
         self.job_active = False
+        self.job_open = 0
+        self.job_generation += 1
                   
 
     def is_queue_empty(self):
-        return len(self.tx_buffer) == 0
+        return len(self.tx_buffer) == 0 and not self._sources
         
     
     def get_queue_percentage_done(self):
-        if self.job_size == 0:
-            return ""
-        return str(100-100*len(self.tx_buffer)/self.job_size)
+        with self.lock:
+            if self.job_size == 0:
+                return ""
+            pct = 100*self.job_sent/self.job_size
+            if self.job_open:
+                pct = min(pct, 99)  # more to come
+            if self.job_lines:
+                # scale by how much of a pipelined job is encoded yet
+                pct = pct*min(self.job_lines_encoded, self.job_lines)/self.job_lines
+            return str(pct)
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics.as_dict()
+
+    def reset_metrics(self):
+        with self.lock:
+            self.metrics.reset()
+
+
+    def get_queue_progress(self):
+        """Percentages of the job encoded and of the encoded data sent."""
+        with self.lock:
+            done = 0 if self.job_active else 100
+            progress = {'encoded': done, 'sent': done, 'active': self.job_active}
+            if self.job_lines:
+                progress['encoded'] = 100*min(self.job_lines_encoded, self.job_lines)/self.job_lines
+            elif self._sources or self.job_open:
+                progress['encoded'] = None  # unknown job length
+            elif self.job_active:
+                progress['encoded'] = 100
+            if self.job_size:
+                progress['sent'] = 100*self.job_sent/self.job_size
+            return progress
 
 
     def set_pause(self, flag):
+        with self.lock:
+            return self._set_pause(flag)
+
+    def _set_pause(self, flag):
         if flag and not self.is_queue_empty():  # pause
-            print "tx_buffer: " + self.tx_buffer
+            print "tx_buffer: %d bytes left" % len(self.tx_buffer)
             self.status['paused'] = True
             return True
         elif not flag:  # unpause
@@ -228,86 +739,135 @@ class SerialManagerClass:
 
     
     def send_queue_as_ready(self):
-        """Continuously call this to keep processing queue."""    
+        """Continuously call this to keep processing queue.
+
+        Blocks for up to RX_TIMEOUT waiting for the device when there
+        is nothing to send right away. This is meant to be driven by
+        the serial thread, see start().
+        """
         if self.device and not self.status['paused']:
             try:
                 ### receiving
-                chars = self.device.read(self.RX_CHUNK_SIZE)
-                if len(chars) > 0:
-                    ## check for data request
-                    if self.ready_char in chars:
-                        # print "=========================== READY"
-                        self.nRequested = self.TX_CHUNK_SIZE
-                        #remove control chars
-                        chars = chars.replace(self.ready_char, "")
-                    ## assemble lines
-                    self.rx_buffer += chars
-                    while(1):  # process all lines in buffer
-                        posNewline = self.rx_buffer.find('\n')
-                        if posNewline == -1:
-                            break  # no more complete lines
-                        else:  # we got a line
-                            line = self.rx_buffer[:posNewline]
-                            self.rx_buffer = self.rx_buffer[posNewline+1:]
-                        self.process_status_line(line)
-                
-                ### sending
-                if self.tx_buffer:
-                    if self.nRequested > 0:
-                        try:
-                            actuallySent = self.device.write(self.tx_buffer[:self.nRequested])
-                        except serial.SerialTimeoutException:
-                            # skip, report
-                            actuallySent = self.nRequested  # pyserial does not report this sufficiently
-                            sys.stdout.write("\nsend_queue_as_ready: writeTimeoutError\n")
-                            sys.stdout.flush()
-                        # sys.stdout.write(self.tx_buffer[:actuallySent])  # print w/ newline
-                        self.tx_buffer = self.tx_buffer[actuallySent:]
-                        self.nRequested -= actuallySent
-                        if self.nRequested <= 0:
-                            self.last_request_ready = 0  # make sure to request ready
-                    else:
-                        if (time.time()-self.last_request_ready) > 2.0:
-                            # ask to send a ready byte
-                            # only ask for this when sending is on hold
-                            # only ask once (and after a big time out)
-                            # print "=========================== REQUEST READY"
-                            try:
-                                actuallySent = self.device.write(self.request_ready_char)
-                            except serial.SerialTimeoutException:
-                                # skip, report
-                                actuallySent = self.nRequested  # pyserial does not report this sufficiently
-                                sys.stdout.write("\nsend_queue_as_ready: writeTimeoutError, on ready request\n")
-                                sys.stdout.flush()
-                            if actuallySent == 1:
-                                self.last_request_ready = time.time()
-                         
-                else:
-                    if self.job_active:
-                        # print "\nG-code stream finished!"
-                        # print "(LasaurGrbl may take some extra time to finalize)"
-                        self.job_size = 0
-                        self.job_active = False
-                        # ready whenever a job is done, including a status request via '?'
-                        self.status['ready'] = True
+                chars = self._read_available()
+                with self.lock:
+                    self._receive(chars)
+                    ### sending
+                    self._transmit()
             except OSError:
                 # Serial port appears closed => reset
                 self.close()
             except ValueError:
                 # Serial port appears closed => reset
                 self.close()     
+            except serial.SerialException:
+                # Device went away (e.g. unplugged) => reset
+                self.close()
         else:
             # serial disconnected    
             self.status['ready'] = False  
 
 
+    def _read_available(self):
+        if self.tx_buffer and self.nRequested > 0:
+            # can send right away, only pick up what is already there
+            waiting = self.device.inWaiting()
+            if waiting == 0:
+                return ""
+            return self.device.read(min(waiting, self.RX_CHUNK_SIZE))
+        # block until the first char arrives (or RX_TIMEOUT)
+        # so a ready char gets answered without any polling delay
+        chars = self.device.read(1)
+        if chars:
+            waiting = self.device.inWaiting()
+            if waiting > 0:
+                chars += self.device.read(min(waiting, self.RX_CHUNK_SIZE-1))
+        return chars
+
+
+    def _receive(self, chars):
+        if len(chars) > 0:
+            self.metrics.bytes_received += len(chars)
+            ## check for data request
+            if self.ready_char in chars:
+                # print "=========================== READY"
+                self.metrics.ready(chars.count(self.ready_char), time.time())
+                self.nRequested = self.TX_CHUNK_SIZE
+                #remove control chars
+                chars = chars.replace(self.ready_char, "")
+            ## assemble lines
+            self.rx_buffer += chars
+            while(1):  # process all lines in buffer
+                posNewline = self.rx_buffer.find('\n')
+                if posNewline == -1:
+                    break  # no more complete lines
+                else:  # we got a line
+                    line = self.rx_buffer[:posNewline]
+                    self.rx_buffer = self.rx_buffer[posNewline+1:]
+                self.process_status_line(line)
+
+
+    def _transmit(self):
+        if self._sources and len(self.tx_buffer) < self.TX_LOW_WATER:
+            self._refill()
+        now = time.time()
+        self.metrics.starving(len(self.tx_buffer) > 0 and self.nRequested <= 0, now)
+        if self.tx_buffer:
+            if self.nRequested > 0:
+                try:
+                    actuallySent = self.device.write(self.tx_buffer.peek(self.nRequested))
+                except serial.SerialTimeoutException:
+                    # skip, report
+                    actuallySent = self.nRequested  # pyserial does not report this sufficiently
+                    self.metrics.write_timeouts += 1
+                    sys.stdout.write("\nsend_queue_as_ready: writeTimeoutError\n")
+                    sys.stdout.flush()
+                # sys.stdout.write(self.tx_buffer.peek(actuallySent))  # print w/ newline
+                self.job_sent += self.tx_buffer.consume(actuallySent)
+                self.metrics.sent(actuallySent, now)
+                self.nRequested -= actuallySent
+                if self.nRequested <= 0:
+                    self.last_request_ready = 0  # make sure to request ready
+                    self.metrics.ready_wait_since = now
+            else:
+                if (time.time()-self.last_request_ready) > 2.0:
+                    # ask to send a ready byte
+                    # only ask for this when sending is on hold
+                    # only ask once (and after a big time out)
+                    # print "=========================== REQUEST READY"
+                    try:
+                        actuallySent = self.device.write(self.request_ready_char)
+                    except serial.SerialTimeoutException:
+                        # skip, report
+                        actuallySent = self.nRequested  # pyserial does not report this sufficiently
+                        self.metrics.write_timeouts += 1
+                        sys.stdout.write("\nsend_queue_as_ready: writeTimeoutError, on ready request\n")
+                        sys.stdout.flush()
+                    if actuallySent == 1:
+                        self.last_request_ready = time.time()
+                 
+        else:
+            if self.job_active and not self.job_open:
+                # print "\nG-code stream finished!"
+                # print "(LasaurGrbl may take some extra time to finalize)"
+                self._reset_job()
+                # ready whenever a job is done, including a status request via '?'
+                self.status['ready'] = True
+
+
 
     def process_status_line(self, line):
         if '#' in line[:3]:
             # print and ignore
             sys.stdout.write(line + "\n")
             sys.stdout.flush()
+            # except for the version in the hello, e.g. "# LasaurGrbl 13.01"
+            pos = line.find(self.LASAURGRBL_FIRST_STRING)
+            if pos > -1:
+                version = line[pos+len(self.LASAURGRBL_FIRST_STRING):].split()
+                if version:
+                    self.status['firmware_version'] = version[0]
         elif '^' in line:
+            self.metrics.fec_corrections += 1
             sys.stdout.write("\nFEC Correction!\n")
             sys.stdout.flush()                                              
         else:
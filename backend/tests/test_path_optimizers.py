@@ -0,0 +1,79 @@
+"""Tests for filereaders.path_optimizers.
+
+Run from the backend directory:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import random
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from filereaders.path_optimizers import PointTree, sort_by_seektime, improve_seektime
+
+
+def segment(rnd, x, y):
+    return array('d', [x, y, x+rnd.uniform(0, 0.01), y+rnd.uniform(0, 0.01)])
+
+
+class PointTreeTest(unittest.TestCase):
+
+    def brute_force(self, points, alive, x, y):
+        found = [((p[0]-x)**2 + (p[1]-y)**2, i) for i, p in enumerate(points) if alive[i]]
+        found.sort()
+        return [i for d2, i in found]
+
+    def test_queries_match_brute_force(self):
+        rnd = random.Random(1)
+        # clustered, coincident and far apart points
+        points = [(rnd.uniform(0, 1), rnd.uniform(0, 1)) for i in range(300)]
+        points += [(rnd.choice([0, 1, 2]), rnd.choice([0, 1])) for i in range(100)]
+        points += [(1e5, 1e5), (-50.0, 3.0)]
+        tree = PointTree(points)
+        alive = [True]*len(points)
+        while tree.count:
+            x = rnd.uniform(-100, 1000)
+            y = rnd.uniform(-100, 1000)
+            expected = self.brute_force(points, alive, x, y)
+            self.assertEqual(tree.nearest(x, y), expected[0])
+            self.assertEqual(tree.k_nearest(x, y, 5), expected[:5])
+            i = rnd.choice(expected)
+            tree.remove(i)
+            alive[i] = False
+        self.assertEqual(tree.nearest(0, 0), None)
+        self.assertEqual(tree.k_nearest(0, 0, 3), [])
+
+
+class SeektimeTest(unittest.TestCase):
+
+    def test_clustered_with_outlier(self):
+        # a tight cluster plus one far outlier used to degrade
+        # the nearest neighbour search to quadratic time
+        rnd = random.Random(3)
+        paths = [segment(rnd, rnd.uniform(0, 1), rnd.uniform(0, 1)) for i in range(10000)]
+        paths.append(segment(rnd, 1e5, 1e5))
+        t = time.time()
+        sort_by_seektime(paths)
+        improve_seektime(paths, max_steps=10000)
+        self.assertTrue(time.time() - t < 10.0)
+        self.assertEqual(len(paths), 10001)
+        self.assertTrue(paths[-1][0] >= 1e5)
+
+    def test_engraving_in_frame(self):
+        # a small engraving in the corner of a big frame
+        rnd = random.Random(4)
+        paths = [segment(rnd, rnd.uniform(0, 20), rnd.uniform(0, 20)) for i in range(10000)]
+        paths += [segment(rnd, 0, 0), segment(rnd, 1200, 600)]
+        t = time.time()
+        sort_by_seektime(paths)
+        improve_seektime(paths, max_steps=10000)
+        self.assertTrue(time.time() - t < 10.0)
+        self.assertTrue(paths[-1][0] >= 1200)
+
+
+if __name__ == '__main__':
+    unittest.main()
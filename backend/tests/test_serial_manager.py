@@ -0,0 +1,116 @@
+"""Tests for serial_manager, run against the lasaur:// firmware simulator.
+
+Run from the backend directory:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from serial_manager import SerialManagerClass
+
+
+class StreamedJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SerialManagerClass()
+        self.manager.start()
+        # slow planner, so the job is still running when stopped
+        self.manager.connect('lasaur://lps=200', 57600)
+        # record everything that goes over the wire
+        self.written = []
+        device = self.manager.device
+        device_write = device.write
+        def write(data):
+            self.written.append(bytes(data))
+            return device_write(data)
+        device.write = write
+
+    def tearDown(self):
+        self.manager.close()
+        self.manager.stop()
+
+    def wait_until_sent(self, timeout=5.0):
+        end = time.time() + timeout
+        while not self.manager.is_queue_empty() and time.time() < end:
+            time.sleep(0.01)
+
+    def test_stop_drops_later_parts(self):
+        m = self.manager
+        job = m.begin_job()
+        self.assertTrue(m.queue_gcode_program(['G0X%dY1' % i for i in range(1, 50)], job))
+        time.sleep(0.2)
+        # stop as sent by the frontend, mid-upload
+        m.queue_gcode_line('!')
+        self.assertFalse(m.queue_gcode_program(['G0X999Y999', 'G0X998Y998'], job))
+        m.end_job(job)
+        # resume, after the stop got reported back like the frontend does
+        time.sleep(0.5)
+        m.queue_gcode_program(['~', 'G0X0Y0F20000'])
+        self.wait_until_sent()
+        time.sleep(0.2)
+        written = ''.join(self.written)
+        self.assertTrue('G0X0Y0F20000' in written)
+        self.assertFalse('X999' in written)
+        self.assertFalse('X998' in written)
+        self.assertNotEqual(m.device.pos['X'], 998.0)
+
+    def test_firmware_stop_drops_later_parts(self):
+        m = self.manager
+        job = m.begin_job()
+        self.assertTrue(m.queue_gcode_program(['G0X1Y1', 'G0X2Y2'], job))
+        # stop code reported by the firmware
+        m.process_status_line('!BX2.00Y2.00')
+        self.assertFalse(m.queue_gcode_program(['G0X999Y999'], job))
+        m.end_job(job)
+        self.wait_until_sent()
+        self.assertFalse('X999' in ''.join(self.written))
+        self.assertFalse(m.job_active)
+
+    def test_parts_of_running_job(self):
+        m = self.manager
+        job = m.begin_job()
+        self.assertTrue(m.queue_gcode_program(['G0X1Y1'], job))
+        self.wait_until_sent()
+        self.assertTrue(m.job_active)
+        self.assertTrue(m.queue_gcode_program(['G0X7Y7'], job))
+        m.end_job(job)
+        self.wait_until_sent()
+        time.sleep(0.2)
+        self.assertTrue('G0X7Y7' in ''.join(self.written))
+        self.assertFalse(m.job_active)
+
+
+class FirmwareVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SerialManagerClass()
+        self.manager.start()
+        self.manager.connect('lasaur://', 57600)
+
+    def tearDown(self):
+        self.manager.close()
+        self.manager.stop()
+
+    def wait_for_version(self, timeout=2.0):
+        end = time.time() + timeout
+        while not self.manager.status['firmware_version'] and time.time() < end:
+            time.sleep(0.01)
+        return self.manager.status['firmware_version']
+
+    def test_version_from_hello(self):
+        # no status query, the hello banner has it
+        self.assertEqual(self.wait_for_version(), '13.01-sim')
+
+    def test_version_kept_after_stop(self):
+        self.assertEqual(self.wait_for_version(), '13.01-sim')
+        self.manager.queue_gcode_line('!')
+        self.assertEqual(self.manager.status['firmware_version'], '13.01-sim')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -46,8 +46,10 @@ function send_gcode(gcode, success_msg, progress) {
     if (typeof gcode === "string" && gcode != '') {
       $.ajax({
         type: "POST",
-        url: "/gcode",
-        data: {'gcode_program':gcode},
+        url: "/gcode/stream",
+        data: gcode,
+        contentType: "text/plain",
+        processData: false,
         // dataType: "json",
         success: function (data) {
           if (data == "__ok__") {
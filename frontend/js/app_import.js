@@ -3,6 +3,7 @@ $(document).ready(function(){
   var raw_gcode = null;
   var raw_gcode_by_color = null;
   var path_optimize = 1;
+  var path_refine = 0;
   var forceSvgDpiTo = undefined;
   var minNumPassWidgets = 3;
   var maxNumPassWidgets = 32;
@@ -31,9 +32,8 @@ $(document).ready(function(){
     
     if (browser_supports_file_api) {
       if (input.files[0]) {
-        var fr = new FileReader()
-        fr.onload = sendToBackend
-        fr.readAsText(input.files[0])
+        // file is sent as is, no need to read it here
+        sendToBackend(input.files[0])
       } else {
         $().uxmessage('error', "No file was selected.");
       }
@@ -50,21 +50,26 @@ $(document).ready(function(){
   });
 
 
-  function sendToBackend(e) {
-    var filedata = e.target.result;
-    var fullpath = $('#svg_upload_file_temp').val();
-    var filename = fullpath.split('\\').pop().split('/').pop();
+  function sendToBackend(file) {
+    var filename = file.name;
     var ext = filename.slice(-4);
     if (ext == '.svg' || ext == '.SVG') {
       $().uxmessage('notice', "parsing SVG ...");
     } else if (ext == '.dxf' || ext == '.DXF') {
       $().uxmessage('notice', "parsing DXF ...");
-      $().uxmessage('warning', "DXF import is limited to R14, lines, arcs, lwpolylines, and mm units");
+      $().uxmessage('warning', "DXF import is limited to lines, arcs, polylines, splines, blocks, and mm units");
     }
+    // with name, size and modified time the backend can answer
+    // repeated imports from its cache without parsing
+    var modified = file.lastModified || (file.lastModifiedDate && file.lastModifiedDate.getTime()) || '';
     $.ajax({
       type: "POST",
-      url: "/svg_reader",
-      data: {'filename':filename,'filedata':filedata, 'dpi':forceSvgDpiTo, 'optimize':path_optimize},
+      // raw body upload, parsed by the backend as it streams in
+      url: "/svg_reader/stream?" + $.param({'filename':filename, 'dpi':forceSvgDpiTo, 'optimize':path_optimize,
+                                            'refine':path_refine, 'modified':modified}),
+      data: file,
+      contentType: "text/plain",
+      processData: false,
       dataType: "json",
       success: function (data) {
         if (ext == '.svg' || ext == '.SVG') {
@@ -285,28 +290,39 @@ $(document).ready(function(){
   // forwarding file open click
   $('#svg_import_btn').click(function(e){
     path_optimize = 1;
+    path_refine = 0;
     $('#svg_upload_file').trigger('click');
   });  
   $('#svg_import_72_btn').click(function(e){
     path_optimize = 1;
+    path_refine = 0;
     forceSvgDpiTo = 72;
     $('#svg_upload_file').trigger('click');
     return false;
   });
   $('#svg_import_90_btn').click(function(e){
     path_optimize = 1;
+    path_refine = 0;
     forceSvgDpiTo = 90;
     $('#svg_upload_file').trigger('click');
     return false;
   });
   $('#svg_import_96_btn').click(function(e){
     path_optimize = 1;
+    path_refine = 0;
     forceSvgDpiTo = 96;
     $('#svg_upload_file').trigger('click');
     return false;
   });    
+  $('#svg_import_refine_btn').click(function(e){
+    path_optimize = 1;
+    path_refine = 1;
+    $('#svg_upload_file').trigger('click');
+    return false;
+  });
   $('#svg_import_nop_btn').click(function(e){
     path_optimize = 0;
+    path_refine = 0;
     $('#svg_upload_file').trigger('click');
     return false;
   });  